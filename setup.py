@@ -29,5 +29,8 @@ setup(
     'pathlib',
     'pick',
   ],
+  extras_require={
+    'numpy': ['numpy'],
+  },
   python_requires='>=3.9.*',
 )
@@ -1,4 +1,5 @@
-from typing import Union, Dict, List, Iterable
+from itertools import chain
+from typing import Union, Dict, List, Optional
 
 from playdate_midi_converter.JSON_Elements.JSON_Notes import JSON_Notes
 
@@ -24,14 +25,17 @@ class JSON_Songs():
         self.noiseNotes = None
         self.ticks = 0
 
-    def _compile_notes(self) -> Iterable[List[int]]:
-        return map(lambda n: n.compile(), [
+    def channel_notes(self) -> List[Optional[List[JSON_Notes]]]:
+        return [
             self.sineNotes,
             self.squareNotes,
             self.sawNotes,
             self.triNotes,
             self.noiseNotes,
-        ])
+        ]
+    
+    def _compile_notes(self) -> List[List[int]]:
+        return [list(chain.from_iterable(n.compile() for n in notes or ())) for notes in self.channel_notes()]
     
     def set_notes(self, channel: str, notes: List[JSON_Notes]):
         if channel == "Sine":
@@ -0,0 +1,141 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from mido.midifiles.midifiles import MidiFile
+from mido.midifiles.units import tempo2bpm
+
+
+# kinds of the compact (kind, note, time) track events
+CHANNEL_PREFIX = 0
+NOTE_ON = 1
+NOTE_OFF = 2
+
+
+@dataclass
+class TrackEvents(object):
+    """
+    the events of one track that can emit notes, as (kind, note, time) tuples
+    time is the message's own delta, like mido's msg.time
+    """
+    number: int
+    name: str
+    events: List[Tuple[int, int, int]] = field(default_factory=list)
+
+
+@dataclass
+class TrackInfo(object):
+    """
+    summary of one track from a scan of its messages, without its note events
+    offset and size locate the MTrk chunk; they are None when mido read the file
+    """
+    def __hash__(self) -> int:
+        return hash((
+            self.number,
+            self.name,
+        ))
+
+    number: int
+    name: str
+    offset: Optional[int] = None
+    size: Optional[int] = None
+    event_count: int = 0
+    note_count: int = 0
+    min_delta: Optional[int] = None
+    tempo: Optional[int] = None
+
+
+@dataclass
+class MidiAnalysis(object):
+    """everything conversion needs from a MIDI file, collected in one pass"""
+    ticks_per_beat: int
+    tempo: Optional[int] = None
+    lowest_time: Optional[int] = None
+    tracks: List[TrackEvents] = field(default_factory=list)
+    message_count: int = 0
+
+    def bpm(self, default: int = 80) -> int:
+        """convert tempo to BPM"""
+        if self.tempo is None:
+            return default
+        return round(tempo2bpm(self.tempo))
+
+    def grid(self, default_bpm: int = 80) -> Tuple[int, int]:
+        """evaluate notes to get the note/bpm multiplier"""
+        bpm = self.bpm(default_bpm)
+        sixteenth_note_default = self.ticks_per_beat / 4
+        lowestTime = self.lowest_time
+        if lowestTime is None:
+            # no timed events - nothing to adjust
+            return bpm, sixteenth_note_default
+
+        # since 16th notes are the lowest available Pulp audio resolution, adjust song translation accordingly
+        if lowestTime > sixteenth_note_default:
+            # update BPM and sixteenth note time if lowest note value is an even multiple
+            if lowestTime % sixteenth_note_default == 0:
+                # slow the BPM to account for the decrease in resolution - this allows more song time
+                bpm = round(bpm / (lowestTime / sixteenth_note_default))
+                sixteenth_note_default = lowestTime
+        elif lowestTime < sixteenth_note_default:
+            # update BPM and sixteenth note time if lowest note value is an even multiple
+            if sixteenth_note_default % lowestTime == 0:
+                # increase the BPM to account for the increase in resolution - will result in less song time
+                bpm = round(bpm * (sixteenth_note_default / lowestTime))
+                sixteenth_note_default = lowestTime
+
+        return bpm, sixteenth_note_default
+
+
+def analyze(midi_file: MidiFile) -> MidiAnalysis:
+    """
+    single pass over every message collecting the tempo (first set_tempo of
+    track 0), the lowest non-zero non-meta delta and each track's note events
+    """
+    analysis = MidiAnalysis(midi_file.ticks_per_beat)
+    lowest_time = None
+    message_count = 0
+    for number, midi_track in enumerate(midi_file.tracks):
+        name = None
+        events = []
+        for msg in midi_track:
+            time = msg.time
+            kind = msg.type
+            if msg.is_meta:
+                if kind == "channel_prefix":
+                    events.append((CHANNEL_PREFIX, 0, time))
+                elif kind == "track_name":
+                    if name is None:
+                        name = msg.name
+                elif kind == "set_tempo":
+                    if number == 0 and analysis.tempo is None:
+                        analysis.tempo = msg.tempo
+                continue
+            # does not account for polyphonic / concurrent note events
+            if time > 0 and (lowest_time is None or lowest_time > time):
+                lowest_time = time
+            if kind == "note_on":
+                events.append((NOTE_ON, msg.note, time))
+            elif kind == "note_off":
+                events.append((NOTE_OFF, msg.note, time))
+        message_count += len(midi_track)
+        analysis.tracks.append(TrackEvents(number, name or '', events))
+    analysis.lowest_time = lowest_time
+    analysis.message_count = message_count
+    return analysis
+
+
+def index(midi_file: MidiFile) -> List[TrackInfo]:
+    """summarize every track of a file mido has already read"""
+    infos = []
+    for number, midi_track in enumerate(midi_file.tracks):
+        info = TrackInfo(number, midi_track.name, event_count=len(midi_track))
+        for msg in midi_track:
+            if msg.is_meta:
+                if msg.type == "set_tempo" and info.tempo is None:
+                    info.tempo = msg.tempo
+                continue
+            if msg.time > 0 and (info.min_delta is None or info.min_delta > msg.time):
+                info.min_delta = msg.time
+            if msg.type == "note_on":
+                info.note_count += 1
+        infos.append(info)
+    return infos
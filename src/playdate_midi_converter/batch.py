@@ -0,0 +1,278 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import partial
+from glob import glob, has_magic
+from itertools import islice
+from logging import ERROR
+from typing import Callable, IO, Iterable, Iterator, List, Optional, Tuple
+
+from playdate_midi_converter import worker
+from playdate_midi_converter.json import write_songs
+from playdate_midi_converter.metrics import MetricsRegistry
+from playdate_midi_converter.midi import Midi
+from playdate_midi_converter.song import Channel, Song
+from playdate_midi_converter.tracing import Tracer
+from playdate_midi_converter.ui.common.channel_mapping import ChannelMapper
+from playdate_midi_converter.ui.rules.channel_mapping import RulesChannelMapper
+
+
+MIDI_EXTENSIONS = ('.mid', '.midi', '.smf')
+
+@dataclass
+class BatchJob:
+    file_in: str
+    file_out: Optional[str]
+    max_notes: int = 512
+    pretty: bool = False
+    engine: str = 'python'
+    reader: str = 'smf'
+
+
+@dataclass
+class BatchResult:
+    file_in: str
+    file_out: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def find_inputs(sources: Iterable[str], manifest: Optional[str] = None) -> List[str]:
+    """
+    expand directories, globs and an optional manifest file
+    into a de-duplicated list of MIDI file paths
+    """
+    found = []
+    if manifest is not None:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        sources = list(sources) + [line for line in lines if line and not line.startswith('#')]
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(MIDI_EXTENSIONS):
+                        found.append(os.path.join(root, name))
+        elif has_magic(source):
+            found.extend(sorted(p for p in glob(source, recursive=True) if os.path.isfile(p)))
+        else:
+            found.append(source)
+    return list(dict.fromkeys(os.path.normpath(p) for p in found))
+
+
+def plan_jobs(files: List[str], out_dir: Optional[str] = None, max_notes: int = 512, pretty: bool = False, engine: str = 'python', reader: str = 'smf') -> List[BatchJob]:
+    """
+    pair every input with an output path; outputs go next to the inputs,
+    or mirror the input layout below out_dir
+    """
+    if out_dir is not None and files:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+    jobs = []
+    for file_in in files:
+        if out_dir is None:
+            file_out = file_in + '.json'
+        else:
+            file_out = os.path.join(out_dir, os.path.relpath(os.path.abspath(file_in), root) + '.json')
+        jobs.append(BatchJob(file_in, file_out, max_notes=max_notes, pretty=pretty, engine=engine, reader=reader))
+    return jobs
+
+
+def run_batch(jobs: List[BatchJob], workers: int = 1, log_level: int = ERROR, mapper: ChannelMapper = None, cache_dir: str = None, metrics: MetricsRegistry = None, tracer: Tracer = None) -> List[BatchResult]:
+    """
+    convert all jobs, in parallel when workers > 1; results keep the job order
+    the mapper is sent to each worker once and reused for all of its files
+    all workers share the conversion cache in cache_dir, if given
+    the conversion metrics and trace events of every worker are added to
+    metrics and tracer, if given
+    a file whose worker process dies fails on its own, the other files still convert
+    """
+    results = []
+    for result, snapshot, events in _map_jobs(convert_file, _failed_file, jobs, workers, log_level, mapper, cache_dir, metrics, tracer):
+        _collect(metrics, tracer, snapshot, events, result.ok)
+        results.append(result)
+    return results
+
+
+def run_pack(jobs: List[BatchJob], fp: IO[str], pretty: bool = False, workers: int = 1, log_level: int = ERROR, mapper: ChannelMapper = None, cache_dir: str = None, first_id: int = 0, metrics: MetricsRegistry = None, tracer: Tracer = None) -> List[BatchResult]:
+    """
+    convert all jobs into a single songs array streamed into fp, with ids
+    numbered from first_id in job order; files are converted in parallel
+    when workers > 1, but written one at a time as soon as they are ready
+    after a failure nothing more is written and the rest are only converted
+    to report their errors too, so fp should be discarded if any result failed
+    """
+    results = []
+
+    def songs():
+        failed = False
+        outcomes = convert_songs(jobs, workers, log_level, mapper, cache_dir, metrics, tracer)
+        for song_id, (job, (song, error)) in enumerate(zip(jobs, outcomes), first_id):
+            results.append(BatchResult(job.file_in, error=error))
+            failed = failed or error is not None
+            if not failed:
+                song.id = song_id
+                if tracer is None:
+                    yield song
+                else:
+                    # the writer encodes the song while this generator waits
+                    with tracer.span('serialize', path=job.file_in):
+                        yield song
+
+    write_songs(songs(), fp, pretty)
+    return results
+
+
+def convert_songs(jobs: List[BatchJob], workers: int = 1, log_level: int = ERROR, mapper: ChannelMapper = None, cache_dir: str = None, metrics: MetricsRegistry = None, tracer: Tracer = None) -> Iterator[Tuple[Optional[Song], Optional[str]]]:
+    """
+    convert jobs to songs named after their files, in parallel when workers > 1
+    yields a (song, None) or (None, error) pair per job, in job order
+    """
+    for outcome, snapshot, events in _map_jobs(_try_convert_song, _failed_song, jobs, workers, log_level, mapper, cache_dir, metrics, tracer):
+        _collect(metrics, tracer, snapshot, events, outcome[1] is None)
+        yield outcome
+
+
+def _map_jobs(convert, failed: Callable[[BatchJob, str], object], jobs: List[BatchJob], workers: int, log_level: int, mapper: Optional[ChannelMapper], cache_dir: Optional[str], metrics: Optional[MetricsRegistry], tracer: Optional[Tracer]):
+    """
+    convert(job) for every job in worker processes, in job order, with what _measure recorded
+    up to workers * 4 jobs are in flight; a job whose worker could not return its result
+    gives failed(job, error) instead
+    """
+    if mapper is None:
+        mapper = RulesChannelMapper(fill=True)
+    measured = partial(_measure, convert)
+    initargs = (log_level, cache_dir, mapper, False, metrics is not None, tracer is not None)
+    if workers <= 1 or len(jobs) <= 1:
+        worker.init_worker(*initargs)
+        yield from map(measured, jobs)
+        return
+    remaining = iter(jobs)
+    pending = deque()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=worker.init_worker, initargs=initargs)
+    try:
+        while True:
+            for job in islice(remaining, workers * 4 - len(pending)):
+                pending.append((job, pool.submit(measured, job)))
+            if not pending:
+                return
+            job, future = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # a dying worker breaks the whole pool, failing every job in flight; the others go to a
+                # new pool, and this one is retried on its own so that it can only fail itself
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=workers, initializer=worker.init_worker, initargs=initargs)
+                pending = deque((queued, f if _succeeded(f) else pool.submit(measured, queued)) for queued, f in pending)
+                result = _measure_alone(measured, failed, job, initargs)
+            except Exception as e:
+                result = failed(job, f"{e!s}" or e.__class__.__name__), None, None
+            yield result
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _failed_file(job: BatchJob, error: str) -> BatchResult:
+    return BatchResult(job.file_in, error=error)
+
+
+def _failed_song(job: BatchJob, error: str) -> Tuple[Optional[Song], Optional[str]]:
+    return None, error
+
+
+def _succeeded(future) -> bool:
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+def _measure_alone(measured, failed: Callable[[BatchJob, str], object], job: BatchJob, initargs: tuple):
+    """measured(job) in a worker process of its own, so that only this job fails if the worker dies"""
+    with ProcessPoolExecutor(max_workers=1, initializer=worker.init_worker, initargs=initargs) as pool:
+        try:
+            return pool.submit(measured, job).result()
+        except Exception as e:
+            return failed(job, f"{e!s}" or e.__class__.__name__), None, None
+
+
+def _measure(convert, job: BatchJob):
+    """convert(job) in a worker, with the metrics snapshot and trace events it recorded when they are on"""
+    metrics = worker.context.metrics
+    tracer = worker.tracer
+    if metrics is not None:
+        metrics.reset()
+    if tracer is None:
+        result = convert(job)
+    else:
+        with tracer.span(os.path.basename(job.file_in), 'file', path=job.file_in):
+            result = convert(job)
+    snapshot = metrics.snapshot() if metrics is not None else None
+    events = tracer.take() if tracer is not None else None
+    return result, snapshot, events
+
+
+def _collect(metrics: Optional[MetricsRegistry], tracer: Optional[Tracer], snapshot: Optional[dict], events: Optional[list], ok: bool):
+    """add what a worker recorded for one job to the metrics and tracer of the batch"""
+    if metrics is not None:
+        if snapshot is not None:
+            metrics.merge(snapshot)
+        if not ok:
+            metrics.inc('conversion_errors_total')
+    if tracer is not None and events:
+        pid = events[0]['pid']
+        tracer.name_process(pid, f"worker {pid}")
+        tracer.extend(events)
+
+
+def convert_song(job: BatchJob) -> Song:
+    """convert a single file to a song named after it"""
+    with worker.context.stage('open'):
+        midi = Midi(worker.context, job.file_in, clip=True, max_notes=job.max_notes, engine=job.engine, reader=job.reader)
+    song = convert_mapped(midi, worker.mapper)
+    song.name = os.path.splitext(os.path.basename(job.file_in))[0]
+    return song
+
+
+def convert_file(job: BatchJob) -> BatchResult:
+    """convert a single file; errors are returned instead of raised"""
+    try:
+        song = convert_song(job)
+        out_dir = os.path.dirname(job.file_out)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        # stream into a temporary file so a failed write never leaves a partial song behind
+        tmp = job.file_out + '.tmp'
+        try:
+            with open(tmp, 'w') as f, worker.context.stage('serialize'):
+                write_songs([song], f, job.pretty)
+            os.replace(tmp, job.file_out)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    except Exception as e:
+        return BatchResult(job.file_in, error=f"{e!s}" or e.__class__.__name__)
+    return BatchResult(job.file_in, job.file_out)
+
+
+def convert_mapped(midi: Midi, mapper: ChannelMapper) -> Song:
+    """map channels on the track index, then decode only the mapped tracks"""
+    with midi.context.stage('map'):
+        tracks = [track for track in midi.track_index() if track.number != 0]
+        track_mappings = mapper.tracks_to_channels(tracks, list(Channel))
+        channels = {track.number: channel for track, channel in track_mappings.items() if channel is not None}
+    song = midi.convert(tracks=channels)
+    with midi.context.stage('map'):
+        song.map_channels({track: channels[track.number] for track in song.tracks})
+    return song
+
+
+def _try_convert_song(job: BatchJob) -> Tuple[Optional[Song], Optional[str]]:
+    try:
+        return convert_song(job), None
+    except Exception as e:
+        return None, f"{e!s}" or e.__class__.__name__
@@ -0,0 +1,183 @@
+"""
+Conversion benchmarks
+
+Times each stage of a conversion separately, for a set of MIDI files plus
+synthetic files scaled up from a few hundred notes per track:
+
+    parse      Midi() and its analysis (the SMF reader decodes lazily)
+    evaluate   Midi._evaluate_notes, the tempo and note grid
+    extract    Midi._get_notes for every track
+    assemble   Track and Song objects, channel mapping
+    serialize  song_to_json
+
+Each case runs repeat times and keeps the fastest time of every stage, then
+once more under tracemalloc for its peak memory. Results are plain JSON, so a
+saved run can be compared with a later one to flag regressions.
+"""
+import platform
+import time
+import tracemalloc
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Dict, Iterable, List
+
+from playdate_midi_converter.__version__ import __VERSION__
+from playdate_midi_converter.config import Config, Context
+from playdate_midi_converter.generate import GeneratorOptions, generate_bytes
+from playdate_midi_converter.json import song_to_json
+from playdate_midi_converter.midi import Midi
+from playdate_midi_converter.song import Channel, Song, Track
+
+
+STAGES = ('parse', 'evaluate', 'extract', 'assemble', 'serialize')
+# notes per track of a synthetic case with scale 1
+SYNTHETIC_NOTES = 256
+SYNTHETIC_TRACKS = 4
+DEFAULT_SCALES = (1, 10, 100)
+DEFAULT_THRESHOLD = 0.10
+# differences below these are noise, not regressions
+_NOISE_SECONDS = 0.0005
+_NOISE_BYTES = 64 * 1024
+
+
+@dataclass
+class BenchCase:
+    name: str
+    data: bytes
+
+
+def file_cases(files: Iterable[str]) -> List[BenchCase]:
+    cases = []
+    for file in files:
+        with open(file, 'rb') as f:
+            cases.append(BenchCase(file, f.read()))
+    return cases
+
+
+def synthetic_case(scale: int) -> BenchCase:
+    """a generated file with SYNTHETIC_TRACKS tracks of scale * SYNTHETIC_NOTES notes, the same for every run"""
+    # half the density of the default, so tracks have rests and sustained notes
+    options = GeneratorOptions(seed=scale, tracks=SYNTHETIC_TRACKS, notes=scale * SYNTHETIC_NOTES, density=2.0)
+    return BenchCase(f'synthetic x{scale}', generate_bytes(options))
+
+
+def run_case(context: Context, case: BenchCase, max_notes: int = 0, engine: str = 'python', reader: str = 'smf') -> Dict[str, Any]:
+    """convert case once, timing every stage"""
+    times = {}
+    started = time.perf_counter()
+    # generated inputs can be larger than the per-file ceiling of conversions
+    midi = Midi(context, BytesIO(case.data), clip=True, max_notes=max_notes, engine=engine, reader=reader, max_bytes=0)
+    analysis = midi.analyze()
+    times['parse'], started = _lap(started)
+
+    bpm, sixteenth_note_default = midi._evaluate_notes(analysis)
+    times['evaluate'], started = _lap(started)
+
+    notes = [(track, midi._get_notes(track.events, sixteenth_note_default, max_notes)) for track in analysis.tracks if track.number != 0]
+    times['extract'], started = _lap(started)
+
+    tracks = [Track(track.number, track.name, track_notes, len(track_notes)) for track, track_notes in notes]
+    song = Song(id=0, bpm=bpm, name=case.name, tracks=tracks)
+    # the first tracks fill the channels in order, as in batch conversions
+    song.map_channels({track: channel for track, channel in zip(tracks, Channel)})
+    times['assemble'], started = _lap(started)
+
+    song_to_json([song])
+    times['serialize'], started = _lap(started)
+
+    return {
+        'stages': times,
+        'events': analysis.message_count,
+        'steps': sum(len(track_notes) for _, track_notes in notes),
+    }
+
+
+def bench(cases: Iterable[BenchCase], repeat: int = 5, max_notes: int = 0, engine: str = 'python', reader: str = 'smf') -> Dict[str, Any]:
+    """benchmark every case; returns the results as a JSON-compatible dict"""
+    # no caches, so every run does the full conversion
+    context = Context(Config())
+    results = {}
+    for case in cases:
+        best = None
+        for _ in range(max(1, repeat)):
+            run = run_case(context, case, max_notes, engine, reader)
+            if best is None:
+                best = run
+            else:
+                best['stages'] = {stage: min(best['stages'][stage], run['stages'][stage]) for stage in STAGES}
+        tracemalloc.start()
+        try:
+            run_case(context, case, max_notes, engine, reader)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        best['bytes'] = len(case.data)
+        best['total'] = sum(best['stages'].values())
+        best['peak_memory'] = peak
+        results[case.name] = best
+
+    total = sum(result['total'] for result in results.values())
+    return {
+        'version': __VERSION__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'repeat': repeat, 'max_notes': max_notes, 'engine': engine, 'reader': reader},
+        'cases': results,
+        'summary': {
+            'seconds': total,
+            'files_per_s': _rate(len(results), total),
+            'events_per_s': _rate(sum(result['events'] for result in results.values()), total),
+            'steps_per_s': _rate(sum(result['steps'] for result in results.values()), total),
+            'peak_memory': max((result['peak_memory'] for result in results.values()), default=0),
+        },
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """the stages and peak memory of cases in both runs that got worse by more than threshold"""
+    regressions = []
+    for name, result in results['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None:
+            continue
+        for stage in STAGES + ('total',):
+            new = result['stages'][stage] if stage != 'total' else result['total']
+            old = base['stages'].get(stage) if stage != 'total' else base.get('total')
+            if old is not None and new > old * (1 + threshold) and new - old > _NOISE_SECONDS:
+                change = f" ({new / old - 1:+.0%})" if old else ''
+                regressions.append(f"{name}: {stage} {_ms(old)} -> {_ms(new)}{change}")
+        old = base.get('peak_memory')
+        new = result['peak_memory']
+        if old and new > old * (1 + threshold) and new - old > _NOISE_BYTES:
+            regressions.append(f"{name}: peak memory {old / 1024:.0f} KiB -> {new / 1024:.0f} KiB ({new / old - 1:+.0%})")
+    return regressions
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    """a table of stage times in milliseconds per case, then the throughput"""
+    width = max([len('case')] + [len(name) for name in results['cases']])
+    header = f"{'case':<{width}}" + ''.join(f"{stage:>11}" for stage in STAGES + ('total',)) + f"{'events':>10}{'steps':>10}{'peak KiB':>10}"
+    lines = [header, '-' * len(header)]
+    for name, result in results['cases'].items():
+        times = [result['stages'][stage] for stage in STAGES] + [result['total']]
+        lines.append(f"{name:<{width}}" + ''.join(f"{t * 1000:>11.2f}" for t in times)
+                     + f"{result['events']:>10}{result['steps']:>10}{result['peak_memory'] / 1024:>10.0f}")
+    summary = results['summary']
+    lines.append('')
+    lines.append(f"{summary['files_per_s']:.1f} files/s, {summary['events_per_s']:.0f} events/s, {summary['steps_per_s']:.0f} steps/s, "
+                 f"peak {summary['peak_memory'] / 1024:.0f} KiB")
+    return '\n'.join(lines)
+
+
+def _lap(started: float):
+    now = time.perf_counter()
+    return now - started, now
+
+
+def _rate(count: int, seconds: float) -> float:
+    return count / seconds if seconds > 0 else 0.0
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.2f}ms"
+
@@ -0,0 +1,271 @@
+"""
+Conversion caches
+
+ConversionCache keeps conversion results on disk, as one JSON file per key:
+track indexes as their fields and songs as the note onsets of each track, so
+reading an entry never runs code from the file. A key is a hash of the MIDI
+file's bytes plus every option that affects the result, so any change to the
+file or the options simply misses. Writes go through a temporary file and
+os.replace, so concurrent converters never read a partial entry. Once the
+directory grows past max_bytes the least recently used entries (by mtime,
+which reads refresh) are removed. Each cache keeps a running total of the
+directory's size, so the directory is only scanned again when that total
+passes max_bytes or every RESCAN_WRITES writes, to notice other processes.
+
+MidiCache keeps the parsed state of recently used files in memory, for
+long-running hosts that convert the same file repeatedly with different
+channel mappings or names.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from playdate_midi_converter.__version__ import __VERSION__
+from playdate_midi_converter.analysis import MidiAnalysis, TrackInfo
+from playdate_midi_converter.song import Song, SparseNotes, Track
+
+
+# bump when the entry format changes or conversions give different results
+CACHE_VERSION = 3
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+# writes between scans of the directory, which other processes may be filling too
+RESCAN_WRITES = 256
+
+# rough sizes of the parsed state, for the memory bound of MidiCache
+_EVENT_BYTES = sys.getsizeof((0, 0, 0)) + 8
+_TRACK_BYTES = 512
+
+_SUFFIX = '.json'
+# entries of earlier versions, which are removed when found
+_OLD_SUFFIXES = ('.pickle',)
+# evicting down to this share of max_bytes leaves room for a run of writes
+_LOW_WATER = 0.9
+
+
+class ConversionCache(object):
+    directory: str
+    max_bytes: int
+    bytes: int
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._writes = 0
+        self.bytes = self._scan()[1]
+
+    @staticmethod
+    def key(data: bytes, **options) -> str:
+        """hash of the input bytes, the options and the converter version"""
+        digest = hashlib.sha256(data)
+        digest.update(repr((__VERSION__, CACHE_VERSION, sorted(options.items()))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """the cached JSON value, or None when missing or unreadable"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated - treat as a miss
+            self._remove(path)
+            return None
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any):
+        """store a JSON value atomically, then evict old entries if over max_bytes"""
+        path = self._path(key)
+        text = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self.bytes += len(text) - replaced
+        self._writes += 1
+        if self.bytes > self.max_bytes or self._writes >= RESCAN_WRITES:
+            self._evict()
+
+    def get_index(self, key: str) -> Optional[List[TrackInfo]]:
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            return [TrackInfo(**info) for info in value]
+        except (TypeError, ValueError):
+            self._remove(self._path(key))
+            return None
+
+    def put_index(self, key: str, index: List[TrackInfo]):
+        self.put(key, [vars(info) for info in index])
+
+    def get_song(self, key: str) -> Optional[Song]:
+        """the cached song, with id 0, no name and unmapped tracks"""
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            tracks = []
+            for track in value['tracks']:
+                notes = SparseNotes.from_onsets(track['length'], track['steps'], track['values'], track['octaves'], track['lengths'])
+                notes.truncated = bool(track['truncated'])
+                tracks.append(Track(track['number'], track['name'], notes, track['ticks']))
+            return Song(id=0, bpm=value['bpm'], name=None, tracks=tracks)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            self._remove(self._path(key))
+            return None
+
+    def put_song(self, key: str, song: Song):
+        """store a converted song; its tracks' notes must be SparseNotes"""
+        tracks = []
+        for track in song.tracks:
+            notes = track.notes
+            steps, values, octaves, lengths = zip(*notes.onsets()) if notes.note_count else ((), (), (), ())
+            tracks.append({
+                'number': track.number,
+                'name': track.name,
+                'ticks': track.ticks,
+                'truncated': notes.truncated,
+                'length': len(notes),
+                'steps': steps,
+                'values': values,
+                'octaves': octaves,
+                'lengths': lengths,
+            })
+        self.put(key, {'bpm': song.bpm, 'tracks': tracks})
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX):
+                self._remove(entry.path)
+        self.bytes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def _scan(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        """(mtime, size, path) of every entry and their total size; entries of older versions are removed"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_OLD_SUFFIXES):
+                self._remove(entry.path)
+                continue
+            if not entry.name.endswith(_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        self._writes = 0
+        entries, total = self._scan()
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * _LOW_WATER:
+                    break
+                self._remove(path)
+                total -= size
+        self.bytes = total
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class MidiCache(object):
+    """
+    bounded in-memory LRU of parsed files: each entry is a file's track index
+    and full analysis, keyed by path, mtime and size or by content hash
+    max_bytes bounds the approximate size of the cached events
+    """
+    max_bytes: int
+    bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def path_key(path: str, clip: bool) -> Hashable:
+        stat = os.stat(path)
+        return 'path', os.path.abspath(path), stat.st_mtime_ns, stat.st_size, clip
+
+    @staticmethod
+    def content_key(data: bytes, clip: bool) -> Hashable:
+        return 'sha256', hashlib.sha256(data).hexdigest(), clip
+
+    def get(self, key: Hashable) -> Optional[Tuple[List[TrackInfo], MidiAnalysis]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, index: List[TrackInfo], analysis: MidiAnalysis):
+        size = _TRACK_BYTES * (len(index) + len(analysis.tracks))
+        size += _EVENT_BYTES * sum(len(track.events) for track in analysis.tracks)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = ((index, analysis), size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,5 +1,10 @@
-from logging import Manager, RootLogger, Logger, ERROR
+from logging import Manager, RootLogger, Logger, StreamHandler, ERROR, WARNING
 from configparser import SafeConfigParser, ConfigParser
+from typing import ContextManager, Dict, List, Optional
+
+from playdate_midi_converter.cache import ConversionCache, MidiCache
+from playdate_midi_converter.metrics import MetricsRegistry
+from playdate_midi_converter.profiling import NO_STAGE, enter_stages
 
 
 class Config(object):
@@ -36,11 +41,40 @@ class Config(object):
 class Context(object):
     config: Config
     log_manager: Manager
+    cache: Optional[ConversionCache]
+    midi_cache: Optional[MidiCache]
+    metrics: Optional[MetricsRegistry]
+    hooks: List
 
-    def __init__(self, cfg: Config, log_level: int = ERROR):
+    def __init__(self, cfg: Config, log_level: int = ERROR, cache: ConversionCache = None, midi_cache: MidiCache = None, metrics: MetricsRegistry = None):
         super().__init__()
         self.config = cfg
         self.log_manager = Manager(RootLogger(log_level))
+        if log_level < WARNING:
+            # logging's last resort handler only prints warnings and up
+            self.log_manager.root.addHandler(StreamHandler())
+        self._loggers = {}
+        self.cache = cache
+        self.midi_cache = midi_cache
+        self.metrics = metrics
+        # stage hooks, see profiling
+        self.hooks = []
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """hit/miss/eviction counters of the in-memory MIDI cache"""
+        if self.midi_cache is None:
+            return {}
+        return {'midi': self.midi_cache.stats()}
+
+    def stage(self, name: str) -> ContextManager:
+        """context around one stage of a conversion for the stage hooks; a shared no-op without any"""
+        if not self.hooks:
+            return NO_STAGE
+        return enter_stages(self.hooks, name)
 
     def get_logger(self, name: str) -> Logger:
-        return self.log_manager.getLogger(name)
+        """the named logger, cached so hot paths skip the manager's lock"""
+        logger = self._loggers.get(name)
+        if logger is None:
+            logger = self._loggers[name] = self.log_manager.getLogger(name)
+        return logger
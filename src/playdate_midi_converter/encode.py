@@ -1,6 +1,7 @@
 import os
+from itertools import chain
 from logging import Logger
-from typing import List, Tuple, Any
+from typing import Iterator, List, Tuple, Any
 from json import JSONEncoder
 from dataclasses import is_dataclass, asdict
 
@@ -9,6 +10,7 @@ from mido.midifiles.tracks import MidiTrack
 from mido.midifiles.units import tempo2bpm
 
 from playdate_midi_converter.config import Context
+from playdate_midi_converter.json import join_ints
 from playdate_midi_converter.JSON_Elements import JSON_Songs, JSON_Notes
 from playdate_midi_converter.MIDI_Elements import MIDI_Track
 from playdate_midi_converter.ui.input import choose
@@ -30,25 +32,23 @@ class ConversionError(Exception):
 
 class Converter(object):
     context: Context
+    log: Logger
     
     def __init__(self, context: Context):
         super().__init__()
         self.context = context
-    
-    @property
-    def log(self) -> Logger:
-        return self.context.get_logger(self.__class__.__name__)
+        self.log = context.get_logger(self.__class__.__name__)
     
     def convert(self, midi_file: MidiFile) -> JSON_Songs:
-        self.log.info("Selected MIDI Filename: " + midi_file.filename)
+        self.log.info("Selected MIDI Filename: %s", midi_file.filename)
         
         # get bpm and clock info
         songBPM = self.get_midi_bpm(midi_file)
         ticksPerBeat = midi_file.ticks_per_beat
         sixteenthNoteDefault = ticksPerBeat / 4
         
-        self.log.info("MIDI Ticks per beat: " + str(midi_file.ticks_per_beat))
-        self.log.info("MIDI BPM: " + str(songBPM))
+        self.log.info("MIDI Ticks per beat: %d", midi_file.ticks_per_beat)
+        self.log.info("MIDI BPM: %s", songBPM)
         
         # capture all tracks
         midiTracks = self.get_tracks(midi_file)
@@ -151,16 +151,15 @@ class Converter(object):
         f.write(outputString)
         
         # write note content
-        outputString = self.write_json_notes(json_song)
-        
-        f.write(outputString)
+        for outputString in self._iter_json_notes(json_song):
+            f.write(outputString)
         
         # write post-note content
         outputString = (
             ",".join((
                 '"ticks":' + str(json_song.ticks),
                 '"splits":' + json_song.splits,
-                '"loopFrom":' + str(json_song.loop_from)
+                '"loopFrom":' + str(json_song.loopFrom)
             ))
         )
         
@@ -178,54 +177,18 @@ class Converter(object):
         and write to text string for output
         """
         
-        noteString = "[["
-        
-        if json_song.sineNotes is not None:
-            for i, note in enumerate(json_song.sineNotes):
-                if i == 0:
-                    noteString = noteString + ",".join((str(note.value), str(note.octave), str(note.length)))
-                else:
-                    noteString = ",".join((noteString, str(note.value), str(note.octave), str(note.length)))
-        
-        noteString = noteString + "],["
-        
-        if json_song.squareNotes is not None:
-            for i, note in enumerate(json_song.squareNotes):
-                if i == 0:
-                    noteString = noteString + ",".join((str(note.value), str(note.octave), str(note.length)))
-                else:
-                    noteString = ",".join((noteString, str(note.value), str(note.octave), str(note.length)))
-        
-        noteString = noteString + "],["
-        
-        if json_song.sawNotes is not None:
-            for i, note in enumerate(json_song.sawNotes):
-                if i == 0:
-                    noteString = noteString + ",".join((str(note.value), str(note.octave), str(note.length)))
-                else:
-                    noteString = ",".join((noteString, str(note.value), str(note.octave), str(note.length)))
-        
-        noteString = noteString + "],["
-        
-        if json_song.triNotes is not None:
-            for i, note in enumerate(json_song.triNotes):
-                if i == 0:
-                    noteString = noteString + ",".join((str(note.value), str(note.octave), str(note.length)))
-                else:
-                    noteString = ",".join((noteString, str(note.value), str(note.octave), str(note.length)))
-        
-        noteString = noteString + "],["
-        
-        if json_song.noiseNotes is not None:
-            for i, note in enumerate(json_song.noiseNotes):
-                if i == 0:
-                    noteString = noteString + ",".join((str(note.value), str(note.octave), str(note.length)))
-                else:
-                    noteString = ",".join((noteString, str(note.value), str(note.octave), str(note.length)))
-        
-        noteString = noteString + "]],"
+        return "".join(self._iter_json_notes(json_song))
+    
+    def _iter_json_notes(self, json_song: JSON_Songs) -> Iterator[str]:
+        """yields the note text of each channel in turn, so it is built in linear time"""
         
-        return noteString
+        yield "[["
+        for i, notes in enumerate(json_song.channel_notes()):
+            if i != 0:
+                yield "],["
+            if notes is not None:
+                yield join_ints(chain.from_iterable((note.value, note.octave, note.length) for note in notes))
+        yield "]],"
 
     def get_notes(self, midi_track: MidiTrack, sixteenth_note_default: int) -> Tuple[List[JSON_Notes], int]:
         """get all the notes from a midi track and store in a JSON_Notes object"""
@@ -340,7 +303,7 @@ class Converter(object):
             if i != 0:
                 newTrack = MIDI_Track(i, track, track.name)
                 newTrackCollection.append(newTrack)
-                self.log.info("Track {}: {}".format(i, track.name))
+                self.log.info("Track %d: %s", i, track.name)
         
         return newTrackCollection
 
@@ -359,8 +322,8 @@ class Converter(object):
             synthOptions = availableSynthList
             selectedSynth, selectedIndex = choose(self.context, synthOptions, mappingPrompt)
             
-            self.log.info(
-                f"User selected {selectedSynth} for Track {str(midi_tracks[trackNumber].track_number)} - {midi_tracks[trackNumber].track_name}")
+            self.log.info("User selected %s for Track %s - %s",
+                          selectedSynth, midi_tracks[trackNumber].track_number, midi_tracks[trackNumber].track_name)
             
             if selectedSynth != "Ignore Track":
                 trackValidator = True
@@ -1,32 +1,161 @@
 import io
+import json
 import os
 import sys
-from argparse import ArgumentParser, FileType
-from logging import DEBUG
+import time
+from argparse import SUPPRESS, ArgumentParser, FileType
+from contextlib import ExitStack
+from logging import getLevelName
+from typing import Optional, Tuple
 
 from playdate_midi_converter.__version__ import __VERSION__
 
-from playdate_midi_converter.midi import Midi
+from playdate_midi_converter.bench import DEFAULT_SCALES, DEFAULT_THRESHOLD, bench, compare, file_cases, format_results, synthetic_case
+from playdate_midi_converter.batch import BatchJob, convert_mapped, convert_songs, find_inputs, plan_jobs, run_batch, run_pack
+from playdate_midi_converter.cache import ConversionCache
+from playdate_midi_converter.midi import Midi, ENGINES, READERS
 from playdate_midi_converter.config import Config, Context
-from playdate_midi_converter.json import song_to_json
+from playdate_midi_converter.generate import GeneratorOptions, generate, generate_corpus
+from playdate_midi_converter.json import write_songs
+from playdate_midi_converter.metrics import MetricsRegistry
+from playdate_midi_converter.profiling import StackSampler, StageProfiler, profile_calls
+from playdate_midi_converter.jsonl import run_jsonl
+from playdate_midi_converter.update import update_file
+from playdate_midi_converter.server import ConvertOptions, serve, DEFAULT_HOST, DEFAULT_PORT
 from playdate_midi_converter.ui.cli.channel_mapping import CliChannelMapper
+from playdate_midi_converter.ui.common.channel_mapping import ChannelMapper
+from playdate_midi_converter.ui.rules.channel_mapping import RulesChannelMapper
 from playdate_midi_converter.ui.input import open_file, choose_save_dir
-from playdate_midi_converter.song import Channel, Song, Track
+from playdate_midi_converter.song import Song
+from playdate_midi_converter.tracing import Tracer
+
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 
 
 def run():
   par = ArgumentParser(prog=sys.argv[0], description='Convert Playdate Pulp JSON file to MIDI.')
   par.add_argument('--in', '-i', dest='file_in', default=None)
   par.add_argument('--out', '-o', dest='file_out', default=None)
-  par.add_argument('--pretty', '-p', action='store_true')
-  par.add_argument('--max-notes', '-m', dest='max_notes', default=512, type=int)
+  par.add_argument('--name', '-n', dest='name', default=None, help='Song name. Skips the name prompt.')
+  _add_pretty_argument(par)
+  _add_conversion_arguments(par)
+  _add_mapping_arguments(par)
+  _add_cache_arguments(par)
+  par.add_argument('--jsonl', action='store_true',
+                   help='Read JSON lines conversion jobs from stdin and write one JSON result line per job to stdout.')
+  _add_jobs_argument(par)
+  par.add_argument('--log-level', dest='log_level', choices=LOG_LEVELS, default='WARNING', type=str.upper,
+                   help='Least severe log messages to print, also in batch workers.')
+  par.add_argument('--profile', action='store_true', help='Print the time spent in each conversion stage.')
+  par.add_argument('--profile-cprofile', dest='profile_cprofile', default=None, metavar='FILE', help='Save cProfile stats of the conversion.')
+  par.add_argument('--profile-stacks', dest='profile_stacks', default=None, metavar='FILE',
+                   help='Save sampled stacks of the conversion in the folded format of flame graph tools.')
+  par.add_argument('--trace', default=None, metavar='FILE', help='Save the conversion stages as Chrome trace events.')
   par.add_argument('--version', action='version', version=f'%(prog)s {__VERSION__}')
+  # options the commands repeat default to SUPPRESS there, so a value given before the command still applies
+  commands = par.add_subparsers(dest='command', metavar='COMMAND')
+
+  batch = commands.add_parser('batch', help='Convert many MIDI files without prompting.')
+  batch.add_argument('sources', nargs='*', metavar='SOURCE', help='MIDI files, directories or glob patterns.')
+  batch.add_argument('--manifest', default=None, help='File listing one MIDI path per line.')
+  batch.add_argument('--out-dir', '-o', dest='out_dir', default=None)
+  _add_jobs_argument(batch, command=True)
+  _add_pretty_argument(batch, command=True)
+  _add_conversion_arguments(batch, command=True)
+  _add_mapping_arguments(batch, command=True)
+  _add_cache_arguments(batch, command=True)
+  _add_metrics_arguments(batch)
+
+  pack = commands.add_parser('pack', help='Convert many MIDI files into a single Pulp songs file.')
+  pack.add_argument('sources', nargs='*', metavar='SOURCE', help='MIDI files, directories or glob patterns, in song id order.')
+  pack.add_argument('--manifest', default=None, help='File listing one MIDI path per line.')
+  pack.add_argument('--out', '-o', dest='file_out', required=True, help='Output file, or - for stdout.')
+  pack.add_argument('--first-id', dest='first_id', default=0, type=int, help='Id of the first song.')
+  _add_jobs_argument(pack, command=True)
+  _add_pretty_argument(pack, command=True)
+  _add_conversion_arguments(pack, command=True)
+  _add_mapping_arguments(pack, command=True)
+  _add_cache_arguments(pack, command=True)
+  _add_metrics_arguments(pack)
+
+  update = commands.add_parser('update', help='Replace, insert or remove songs of an existing Pulp songs file by id.')
+  update.add_argument('songs_file', metavar='SONGS_FILE')
+  update.add_argument('--set', dest='sets', action='append', default=[], metavar='ID=MIDI',
+                      help='Convert MIDI as the song with this id, replacing or inserting it.')
+  update.add_argument('--remove', dest='removes', action='append', default=[], type=int, metavar='ID', help='Remove the song with this id.')
+  _add_jobs_argument(update, command=True)
+  _add_pretty_argument(update, command=True, help='Lay out the new songs like --pretty output.')
+  _add_conversion_arguments(update, command=True)
+  _add_mapping_arguments(update, command=True)
+  _add_cache_arguments(update, command=True)
+  _add_metrics_arguments(update)
+
+  server = commands.add_parser('serve', help='Serve conversions over HTTP on localhost from a pool of warm workers.')
+  server.add_argument('--host', default=DEFAULT_HOST)
+  server.add_argument('--port', default=DEFAULT_PORT, type=int)
+  _add_jobs_argument(server, command=True)
+  _add_cache_arguments(server, command=True)
+
+  benchmark = commands.add_parser('bench', help='Time each conversion stage on MIDI files and synthetic inputs.')
+  benchmark.add_argument('sources', nargs='*', metavar='SOURCE', help='MIDI files, directories or glob patterns.')
+  benchmark.add_argument('--scale', dest='scales', action='append', type=int, metavar='N',
+                         help=f"Add a synthetic input N times the base size. Defaults to {', '.join(map(str, DEFAULT_SCALES))}; 0 for none.")
+  benchmark.add_argument('--repeat', '-r', default=5, type=int, help='Runs per input; the fastest time of each stage is kept.')
+  _add_conversion_arguments(benchmark, command=True)
+  benchmark.add_argument('--save', default=None, metavar='FILE', help='Write the results to this JSON file.')
+  benchmark.add_argument('--compare', default=None, metavar='FILE', help='Flag regressions against results saved earlier.')
+  benchmark.add_argument('--threshold', default=DEFAULT_THRESHOLD, type=float,
+                         help='Slowdown that counts as a regression, as a fraction.')
+
+  generator = commands.add_parser('generate', help='Write seeded synthetic MIDI files for benchmarks and stress tests.')
+  generator.add_argument('file_out', metavar='OUT', help='Output file, or directory with --count.')
+  generator.add_argument('--count', default=None, type=int, help='Write this many files with consecutive seeds into OUT.')
+  generator.add_argument('--seed', default=0, type=int)
+  generator.add_argument('--tracks', default=4, type=int, help='Note tracks, besides the tempo track.')
+  generator.add_argument('--notes', default=1000, type=int, help='Note onsets per track.')
+  generator.add_argument('--density', default=4.0, type=float, help='Average onsets per beat.')
+  generator.add_argument('--polyphony', default=1, type=int, help='Most notes started together.')
+  generator.add_argument('--tempo-changes', dest='tempo_changes', default=0, type=int)
+  generator.add_argument('--ticks-per-beat', dest='ticks_per_beat', default=480, type=int)
+  generator.add_argument('--lead-in', dest='lead_in', default=0, type=int, help='Beats of channel_prefix delay before each track.')
+  generator.add_argument('--rest-rate', dest='rest_rate', default=0.0, type=float, help='Share of onsets after a long rest.')
+  generator.add_argument('--rest-beats', dest='rest_beats', default=64, type=int, help='Length of the long rests.')
+  generator.add_argument('--pathological-rate', dest='pathological_rate', default=0.0, type=float,
+                         help='Share of onsets after a delta of 2**20 ticks or more.')
+  generator.add_argument('--no-running-status', dest='running_status', action='store_false')
   
   args = par.parse_args(sys.argv[1:])
+  if args.jobs is None:
+    args.jobs = (os.cpu_count() or 1) if args.command in ('batch', 'pack', 'update', 'serve') else 1
+  if args.max_notes is None:
+    # bench measures whole files unless told otherwise
+    args.max_notes = 0 if args.command == 'bench' else 512
   
   # TODO: Get config data from config file.
   cfg = Config()
-  ctx = Context(cfg, log_level=DEBUG)
+  ctx = Context(cfg, log_level=getLevelName(args.log_level))
+  if args.cache_dir and not args.no_cache:
+    try:
+      ctx.cache = ConversionCache(args.cache_dir)
+    except Exception as e:
+      ctx.log_manager.root.error(f"Cache directory error: {e!s}")
+      sys.exit(1)
+
+  if args.command == 'batch':
+    sys.exit(_run_batch(ctx, args))
+  if args.command == 'pack':
+    sys.exit(_run_pack(ctx, args))
+  if args.command == 'update':
+    sys.exit(_run_update(ctx, args))
+  if args.command == 'serve':
+    sys.exit(_run_server(ctx, args))
+  if args.command == 'bench':
+    sys.exit(_run_bench(ctx, args))
+  if args.command == 'generate':
+    sys.exit(_run_generate(ctx, args))
+  if args.jsonl:
+    sys.exit(_run_jsonl(ctx, args))
 
   if args.file_in == "-":
     if sys.stdin.isatty():
@@ -50,17 +179,30 @@ def run():
       ctx.log_manager.root.error(f"File select error: {e!s}")
       sys.exit(1)
 
+  profiling = _start_profiling(ctx, args)
+  tracer = Tracer() if args.trace else None
+  if tracer is not None:
+    ctx.hooks.append(tracer)
   try:
     if file_in == sys.stdin:
-      midi = Midi(ctx, io.BytesIO(sys.stdin.buffer.read()), clip=True)
+      with ctx.stage('open'):
+        midi = Midi(ctx, io.BytesIO(sys.stdin.buffer.read()), clip=True, max_notes=args.max_notes, engine=args.engine, reader=args.reader)
       # TODO: Reading from stdin this way causes the user input later to error and infinitely loop. Find a way to fix this.
     else:
-      midi = Midi(ctx, file_in, clip=True)
+      with ctx.stage('open'):
+        midi = Midi(ctx, file_in, clip=True, max_notes=args.max_notes, engine=args.engine, reader=args.reader)
   except Exception as e:
     ctx.log_manager.root.error(f"MIDI read error: {e!s}")
     sys.exit(1)
   
-  mapper = CliChannelMapper()
+  user = CliChannelMapper()
+  mapper = user
+  if args.maps or args.rules is not None or args.fill:
+    try:
+      mapper = _rules_mapper(args)
+    except Exception as e:
+      ctx.log_manager.root.error(f"Channel mapping rules error: {e!s}")
+      sys.exit(1)
 
   if args.file_out == "-":
     file_out = sys.stdout
@@ -70,7 +212,7 @@ def run():
     except Exception as e:
       ctx.log_manager.root.error(f"Output file write error: {e!s}")
       sys.exit(1)
-  elif not mapper.yes_no("Save to file?"):
+  elif not user.yes_no("Save to file?"):
     file_out = sys.stdout
   else:
     file_dir = None
@@ -80,14 +222,13 @@ def run():
       out_filename = os.path.basename(file_in.name) + '.json'
     
     try:
-      file_out = _choose_file_out(ctx, mapper, out_filename, file_dir)
+      file_out = _choose_file_out(ctx, user, out_filename, file_dir)
     except Exception as e:
       ctx.log_manager.root.error(f"Output file selection error: {e!s}")
       sys.exit(1)
   
   try:
-    song = _midi_to_song(ctx, mapper, midi)
-    song_json = song_to_json([song], args.pretty)
+    song = _midi_to_song(user, mapper, midi, name=args.name)
   except KeyboardInterrupt as e:
     raise e
   except Exception as e:
@@ -95,17 +236,311 @@ def run():
     sys.exit(1)
   
   try:
-    file_out.write(song_json)
+    with ctx.stage('serialize'):
+      write_songs([song], file_out, args.pretty)
     #file_out.flush()
     #file_out.close()
   except Exception as e:
     ctx.log_manager.root.error(f"JSON file write error: {e!s}")
     sys.exit(1)
   
+  _stop_profiling(args, profiling)
+  _write_trace(ctx, args, tracer)
   ctx.log_manager.root.info(f"SUCCESS!")
   sys.exit(0)
 
 
+def _add_jobs_argument(parser: ArgumentParser, command: bool = False):
+  parser.add_argument('--jobs', '-j', dest='jobs', default=SUPPRESS if command else None, type=int,
+                      help='Worker processes. Defaults to one per CPU.' if command else 'Worker processes for --jsonl, 1 by default, or for the command.')
+
+
+def _add_pretty_argument(parser: ArgumentParser, command: bool = False, help: str = None):
+  parser.add_argument('--pretty', '-p', action='store_true', default=SUPPRESS if command else False, help=help)
+
+
+def _add_conversion_arguments(parser: ArgumentParser, command: bool = False):
+  # the top level --max-notes resolves after parsing, as bench has no limit by default
+  parser.add_argument('--max-notes', '-m', dest='max_notes', default=SUPPRESS if command else None, type=int,
+                      help='Note limit per track, 0 for none. Defaults to 512, or none for bench.')
+  parser.add_argument('--engine', choices=ENGINES, default=SUPPRESS if command else 'python', help='Note extraction engine. "numpy" requires NumPy.')
+  parser.add_argument('--reader', choices=READERS, default=SUPPRESS if command else 'smf',
+                      help='MIDI file reader. "smf" falls back to mido for files it cannot read.')
+
+
+def _add_mapping_arguments(parser: ArgumentParser, command: bool = False):
+  parser.add_argument('--map', dest='maps', action='append', default=SUPPRESS if command else [], metavar='TRACK=CHANNEL[,...]',
+                      help="Map track numbers to channels without prompting, e.g. '1=sine,2=square,3=ignore'.")
+  parser.add_argument('--rules', dest='rules', default=SUPPRESS if command else None, metavar='FILE',
+                      help='Config file with track number mappings and track name pattern rules.')
+  parser.add_argument('--fill', action='store_true', default=SUPPRESS if command else False,
+                      help='Assign unmatched tracks to the remaining channels in order.')
+
+
+def _add_cache_arguments(parser: ArgumentParser, command: bool = False):
+  parser.add_argument('--cache-dir', dest='cache_dir', default=SUPPRESS if command else os.environ.get('PLAYDATE_PULP_MIDI_CACHE'), metavar='DIR',
+                      help='Reuse conversions of unchanged files from this directory. Defaults to $PLAYDATE_PULP_MIDI_CACHE.')
+  parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=SUPPRESS if command else False,
+                      help='Ignore the conversion cache.')
+
+
+def _add_metrics_arguments(parser: ArgumentParser):
+  parser.add_argument('--metrics', default=None, metavar='FILE', help='Write conversion counters and histograms to this file.')
+  parser.add_argument('--metrics-format', dest='metrics_format', choices=('json', 'prometheus'), default='json')
+  # the top level --trace is the default
+  parser.add_argument('--trace', default=SUPPRESS, metavar='FILE',
+                      help='Save the stages of every file on every worker as Chrome trace events, for chrome://tracing or Perfetto.')
+
+
+def _write_trace(ctx: Context, args, tracer: Tracer):
+  if tracer is None:
+    return
+  try:
+    tracer.write(args.trace)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Trace write error: {e!s}")
+
+
+def _write_metrics(ctx: Context, args, metrics: MetricsRegistry):
+  if metrics is None:
+    return
+  try:
+    metrics.write(args.metrics, args.metrics_format)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Metrics write error: {e!s}")
+
+
+def _rules_mapper(args) -> RulesChannelMapper:
+  return RulesChannelMapper.from_options(args.maps, args.rules, fill=args.fill)
+
+
+def _run_batch(ctx: Context, args) -> int:
+  try:
+    files = find_inputs(args.sources, args.manifest)
+    mapper = _rules_mapper(args)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Batch setup error: {e!s}")
+    return 1
+  if not files:
+    ctx.log_manager.root.error("No input files found.")
+    return 1
+
+  jobs = plan_jobs(files, args.out_dir, max_notes=args.max_notes, pretty=args.pretty, engine=args.engine, reader=args.reader)
+  started = time.perf_counter()
+  cache_dir = ctx.cache.directory if ctx.cache is not None else None
+  metrics = MetricsRegistry() if args.metrics else None
+  tracer = Tracer() if args.trace else None
+  results = run_batch(jobs, workers=args.jobs, log_level=ctx.log_manager.root.level, mapper=mapper, cache_dir=cache_dir, metrics=metrics, tracer=tracer)
+  elapsed = time.perf_counter() - started
+  _write_metrics(ctx, args, metrics)
+  _write_trace(ctx, args, tracer)
+
+  failures = [r for r in results if not r.ok]
+  for result in failures:
+    sys.stderr.write(f"FAILED {result.file_in}: {result.error}\n")
+  sys.stderr.write(f"Converted {len(results) - len(failures)} of {len(results)} files ({len(failures)} failed) in {elapsed:.2f}s.\n")
+  return 1 if failures else 0
+
+
+def _run_pack(ctx: Context, args) -> int:
+  try:
+    files = find_inputs(args.sources, args.manifest)
+    mapper = _rules_mapper(args)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Pack setup error: {e!s}")
+    return 1
+  if not files:
+    ctx.log_manager.root.error("No input files found.")
+    return 1
+
+  jobs = [BatchJob(f, None, max_notes=args.max_notes, pretty=args.pretty, engine=args.engine, reader=args.reader) for f in files]
+  cache_dir = ctx.cache.directory if ctx.cache is not None else None
+  metrics = MetricsRegistry() if args.metrics else None
+  tracer = Tracer() if args.trace else None
+  options = dict(pretty=args.pretty, workers=args.jobs, log_level=ctx.log_manager.root.level, mapper=mapper, cache_dir=cache_dir,
+                 first_id=args.first_id, metrics=metrics, tracer=tracer)
+  started = time.perf_counter()
+  try:
+    if args.file_out == '-':
+      results = run_pack(jobs, sys.stdout, **options)
+    else:
+      # write next to the output and only replace it once every song converted
+      tmp = args.file_out + '.tmp'
+      try:
+        with open(tmp, 'w') as f:
+          results = run_pack(jobs, f, **options)
+        if all(r.ok for r in results):
+          os.replace(tmp, args.file_out)
+        else:
+          os.remove(tmp)
+      except BaseException:
+        if os.path.exists(tmp):
+          os.remove(tmp)
+        raise
+  except Exception as e:
+    ctx.log_manager.root.error(f"Pack write error: {e!s}")
+    return 1
+  elapsed = time.perf_counter() - started
+  _write_metrics(ctx, args, metrics)
+  _write_trace(ctx, args, tracer)
+
+  failures = [r for r in results if not r.ok]
+  for result in failures:
+    sys.stderr.write(f"FAILED {result.file_in}: {result.error}\n")
+  if failures:
+    sys.stderr.write(f"Pack not written: {len(failures)} of {len(results)} files failed.\n")
+    return 1
+  sys.stderr.write(f"Packed {len(results)} songs (ids {args.first_id}-{args.first_id + len(results) - 1}) in {elapsed:.2f}s.\n")
+  return 0
+
+
+def _run_update(ctx: Context, args) -> int:
+  try:
+    song_ids, files = [], []
+    for spec in args.sets:
+      song_id, _, file_in = spec.partition('=')
+      if not file_in:
+        raise ValueError(f"Expected ID=MIDI, got '{spec}'.")
+      song_ids.append(int(song_id))
+      files.append(file_in)
+    mapper = _rules_mapper(args)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Update setup error: {e!s}")
+    return 1
+
+  jobs = [BatchJob(f, None, max_notes=args.max_notes, engine=args.engine, reader=args.reader) for f in files]
+  cache_dir = ctx.cache.directory if ctx.cache is not None else None
+  songs = []
+  failed = False
+  metrics = MetricsRegistry() if args.metrics else None
+  tracer = Tracer() if args.trace else None
+  outcomes = convert_songs(jobs, args.jobs, ctx.log_manager.root.level, mapper, cache_dir, metrics, tracer)
+  for song_id, job, (song, error) in zip(song_ids, jobs, outcomes):
+    if error is not None:
+      sys.stderr.write(f"FAILED {job.file_in}: {error}\n")
+      failed = True
+      continue
+    song.id = song_id
+    songs.append(song)
+  _write_metrics(ctx, args, metrics)
+  _write_trace(ctx, args, tracer)
+  if failed:
+    sys.stderr.write(f"{args.songs_file} not updated.\n")
+    return 1
+
+  try:
+    update_file(args.songs_file, songs, args.removes, args.pretty)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Update error: {e!s}")
+    return 1
+  sys.stderr.write(f"Updated {args.songs_file}: {len(songs)} song(s) set, {len(args.removes)} removed.\n")
+  return 0
+
+
+def _run_jsonl(ctx: Context, args) -> int:
+  try:
+    _rules_mapper(args)
+  except Exception as e:
+    ctx.log_manager.root.error(f"JSON lines setup error: {e!s}")
+    return 1
+  cache_dir = ctx.cache.directory if ctx.cache is not None else None
+  defaults = ConvertOptions(max_notes=args.max_notes, maps=args.maps, rules=args.rules, fill=args.fill, engine=args.engine, reader=args.reader)
+  if args.name is not None:
+    defaults.name = args.name
+  failures = run_jsonl(sys.stdin, sys.stdout, workers=args.jobs, log_level=ctx.log_manager.root.level, cache_dir=cache_dir, defaults=defaults)
+  return 1 if failures else 0
+
+
+def _run_server(ctx: Context, args) -> int:
+  cache_dir = ctx.cache.directory if ctx.cache is not None else None
+  def ready(server):
+    host, port = server.server_address[:2]
+    sys.stderr.write(f"Serving conversions on http://{host}:{port}/convert with {args.jobs} workers.\n")
+  try:
+    serve(args.host, args.port, workers=args.jobs, log_level=ctx.log_manager.root.level, cache_dir=cache_dir, ready=ready)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Server error: {e!s}")
+    return 1
+  return 0
+
+
+def _run_bench(ctx: Context, args) -> int:
+  try:
+    cases = file_cases(find_inputs(args.sources))
+    cases += [synthetic_case(scale) for scale in (args.scales or DEFAULT_SCALES) if scale > 0]
+    baseline = None
+    if args.compare is not None:
+      with open(args.compare, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+  except Exception as e:
+    ctx.log_manager.root.error(f"Benchmark setup error: {e!s}")
+    return 1
+  if not cases:
+    ctx.log_manager.root.error("Nothing to benchmark.")
+    return 1
+
+  results = bench(cases, repeat=args.repeat, max_notes=args.max_notes, engine=args.engine, reader=args.reader)
+  print(format_results(results))
+  if args.save is not None:
+    with open(args.save, 'w', encoding='utf-8') as f:
+      json.dump(results, f, indent=2)
+  if baseline is not None:
+    if baseline.get('options') != results['options']:
+      sys.stderr.write(f"Warning: {args.compare} was run with different options: {baseline.get('options')}\n")
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+      sys.stderr.write(f"REGRESSION {regression}\n")
+    if regressions:
+      return 1
+    sys.stderr.write(f"No regressions against {args.compare}.\n")
+  return 0
+
+
+def _run_generate(ctx: Context, args) -> int:
+  fields = ('seed', 'tracks', 'notes', 'density', 'polyphony', 'tempo_changes', 'ticks_per_beat',
+            'lead_in', 'rest_rate', 'rest_beats', 'pathological_rate', 'running_status')
+  options = GeneratorOptions(**{name: getattr(args, name) for name in fields})
+  try:
+    options.validate()
+    if args.count is not None:
+      paths = generate_corpus(args.file_out, args.count, options)
+      sys.stderr.write(f"Wrote {len(paths)} files to {args.file_out}.\n")
+    else:
+      with open(args.file_out, 'wb') as f:
+        size = generate(f, options)
+      sys.stderr.write(f"Wrote {args.file_out} ({size} bytes).\n")
+  except Exception as e:
+    ctx.log_manager.root.error(f"Generate error: {e!s}")
+    return 1
+  return 0
+
+
+def _start_profiling(ctx: Context, args) -> Optional[Tuple[StageProfiler, ExitStack]]:
+  """start the profilers asked for; their stage hook only sees this conversion"""
+  if not (args.profile or args.profile_cprofile or args.profile_stacks):
+    return None
+  profiler = StageProfiler()
+  ctx.hooks.append(profiler)
+  stack = ExitStack()
+  if args.profile_cprofile:
+    stack.enter_context(profile_calls(args.profile_cprofile))
+  if args.profile_stacks:
+    sampler = StackSampler()
+    # callbacks run last first: stop sampling, then write
+    stack.callback(sampler.write, args.profile_stacks)
+    stack.enter_context(sampler)
+  return profiler, stack
+
+
+def _stop_profiling(args, profiling: Optional[Tuple[StageProfiler, ExitStack]]):
+  if profiling is None:
+    return
+  profiler, stack = profiling
+  stack.close()
+  if args.profile:
+    sys.stderr.write(profiler.format_table() + '\n')
+
+
 def _choose_file_in(ctx: Context):
   filename = open_file(ctx)
   return open(filename, mode='rb')
@@ -126,26 +561,13 @@ def _choose_file_out(ctx: Context, mapper: CliChannelMapper, file_name, save_dir
 
   return open(out_file_name, mode='w')
 
-def _midi_to_song(ctx: Context, mapper: CliChannelMapper, midi: Midi) -> Song:
-  song = midi.convert()
-  keep_name = False
+def _midi_to_song(user: CliChannelMapper, mapper: ChannelMapper, midi: Midi, name: str = None) -> Song:
+  keep_name = name is not None
   while not keep_name:
-    song.name = mapper.read_line(f"Song name? ").strip()
-    keep_name = mapper.yes_no(f"Song name \"{song.name}\". Continue?")
+    name = user.read_line(f"Song name? ").strip()
+    keep_name = user.yes_no(f"Song name \"{name}\". Continue?")
   
-  channels = list(Channel)
-  tracks = list()
-  track_mappings = mapper.tracks_to_channels(song.tracks, channels)
-  for track, channel in track_mappings.items():
-    if channel is None: # Ignored
-      continue
-    tracks.append(track)
-    track.channel = channel
-    channels.remove(channel)
-  for channel in channels:
-    empty_track = Track(0, '', [], channel=channel)
-    tracks.append(empty_track)
-  tracks.sort(key=lambda t: t.channel)
-  song.tracks = tracks
-
+  # the prompts map on the track index, so they don't wait for the notes to be decoded
+  song = convert_mapped(midi, mapper)
+  song.name = name
   return song
@@ -0,0 +1,195 @@
+"""
+Synthetic MIDI files
+
+Generates Standard MIDI Files from a seed, for benchmarks and stress tests.
+The same seed and options always give the same bytes. Tracks are built in the
+compact (kind, note, time) event model of analysis.TrackEvents, the same one
+Midi converts from, then written as format 1 SMF one track at a time, so files
+of hundreds of megabytes only ever hold one track in memory.
+
+Besides size (tracks, notes per track, density) the options cover the inputs
+that stress the converter: chords (polyphony), tempo changes, unusual
+ticks_per_beat, long rests and pathological deltas near the largest a
+variable length quantity can hold.
+"""
+import os
+import random
+import struct
+from dataclasses import dataclass, replace
+from io import BytesIO
+from typing import IO, Iterator, List, Tuple
+
+from playdate_midi_converter.analysis import TrackEvents, CHANNEL_PREFIX, NOTE_ON, NOTE_OFF
+
+
+# the largest delta a variable length quantity can hold
+MAX_DELTA = 0x0FFFFFFF
+DEFAULT_TEMPO = 500000
+
+_END_OF_TRACK = b'\x00\xff\x2f\x00'
+_SMALL_VLQ = [bytes((value,)) for value in range(0x80)]
+
+
+@dataclass
+class GeneratorOptions:
+    seed: int = 0
+    # note tracks, after the tempo track 0
+    tracks: int = 4
+    # note onsets per track
+    notes: int = 1000
+    # average onsets per beat
+    density: float = 4.0
+    # most notes started together; 1 keeps every track monophonic
+    polyphony: int = 1
+    tempo_changes: int = 0
+    ticks_per_beat: int = 480
+    # beats of channel_prefix delay before each track's first note
+    lead_in: int = 0
+    # share of onsets preceded by a rest of rest_beats beats
+    rest_rate: float = 0.0
+    rest_beats: int = 64
+    # share of onsets preceded by a delta between 2**20 ticks and MAX_DELTA
+    pathological_rate: float = 0.0
+    running_status: bool = True
+
+    def validate(self):
+        """raises ValueError for options that can't make a valid file"""
+        if not 0 < self.tracks < 0x7FFF:
+            raise ValueError("tracks must be between 1 and 32766.")
+        if not 0 < self.ticks_per_beat < 0x8000:
+            raise ValueError("ticks_per_beat must be between 1 and 32767.")
+        if self.notes < 0 or self.lead_in < 0 or self.rest_beats < 0 or self.tempo_changes < 0:
+            raise ValueError("notes, lead_in, rest_beats and tempo_changes can't be negative.")
+        if self.lead_in * self.ticks_per_beat > MAX_DELTA:
+            raise ValueError("lead_in is too long for a single delta.")
+        if self.density <= 0:
+            raise ValueError("density must be positive.")
+        if not 1 <= self.polyphony <= 12:
+            raise ValueError("polyphony must be between 1 and 12.")
+        if not 0 <= self.rest_rate <= 1 or not 0 <= self.pathological_rate <= 1:
+            raise ValueError("rest_rate and pathological_rate must be between 0 and 1.")
+
+
+def generate_tracks(options: GeneratorOptions) -> Iterator[TrackEvents]:
+    """the note tracks (1 and up) of the file, one at a time"""
+    for number in range(1, options.tracks + 1):
+        # every track has its own generator, so each one can be made on its own
+        rng = random.Random(f"{options.seed}:{number}")
+        yield TrackEvents(number, f"synth {number}", list(_track_events(rng, options)))
+
+
+def generate_tempos(options: GeneratorOptions) -> List[Tuple[int, int]]:
+    """the (delta, tempo) set_tempo events of track 0, spread evenly over the expected song length"""
+    rng = random.Random(f"{options.seed}:0")
+    tempos = [(0, DEFAULT_TEMPO)]
+    length = int(options.notes * options.ticks_per_beat / options.density)
+    interval = length // (options.tempo_changes + 1)
+    for _ in range(options.tempo_changes):
+        tempos.append((interval, rng.randrange(300000, 1000000)))
+    return tempos
+
+
+def generate(fp: IO[bytes], options: GeneratorOptions) -> int:
+    """write a synthetic file to fp; returns the number of bytes written"""
+    options.validate()
+    written = fp.write(b'MThd' + struct.pack('>Lhhh', 6, 1, options.tracks + 1, options.ticks_per_beat))
+    tempo_map = bytearray()
+    for delta, tempo in generate_tempos(options):
+        tempo_map += _vlq(delta) + b'\xff\x51\x03' + tempo.to_bytes(3, 'big')
+    written += _write_chunk(fp, bytes(tempo_map) + _END_OF_TRACK)
+    for track in generate_tracks(options):
+        written += _write_chunk(fp, encode_track(track, (track.number - 1) % 16, options.running_status))
+    return written
+
+
+def generate_bytes(options: GeneratorOptions) -> bytes:
+    buffer = BytesIO()
+    generate(buffer, options)
+    return buffer.getvalue()
+
+
+def generate_corpus(directory: str, count: int, options: GeneratorOptions) -> List[str]:
+    """write count files with consecutive seeds from options.seed; returns their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        seed = options.seed + i
+        path = os.path.join(directory, f"synthetic-{seed}.mid")
+        with open(path, 'wb') as f:
+            generate(f, replace(options, seed=seed))
+        paths.append(path)
+    return paths
+
+
+def encode_track(track: TrackEvents, channel: int = 0, running_status: bool = True) -> bytes:
+    """the MTrk data of a track: its name, then its events on channel"""
+    name = track.name.encode('latin1')
+    data = bytearray(b'\x00\xff\x03' + _vlq(len(name)) + name)
+    last_status = None
+    for kind, note, time in track.events:
+        data += _vlq(time)
+        if kind == CHANNEL_PREFIX:
+            # meta events don't take part in running status
+            data += bytes((0xFF, 0x20, 0x01, channel))
+            continue
+        status = (0x90 if kind == NOTE_ON else 0x80) | channel
+        if status != last_status or not running_status:
+            data.append(status)
+            last_status = status
+        data.append(note)
+        data.append(100 if kind == NOTE_ON else 0)
+    data += _END_OF_TRACK
+    return bytes(data)
+
+
+def _track_events(rng: random.Random, options: GeneratorOptions) -> Iterator[Tuple[int, int, int]]:
+    """(kind, note, time) events of one track: onsets on a sixteenth grid, each note ending by the next onset"""
+    sixteenth = max(1, options.ticks_per_beat // 4)
+    # gaps of 1..longest sixteenths average 4 / density of them
+    longest = max(1, round(8 / options.density - 1))
+    if options.lead_in:
+        yield CHANNEL_PREFIX, 0, options.lead_in * options.ticks_per_beat
+    pending = 0
+    # rng.random() and int() rather than randint and sample, which are several times slower
+    random = rng.random
+    for _ in range(options.notes):
+        if options.rest_rate and random() < options.rest_rate:
+            pending += options.rest_beats * options.ticks_per_beat
+        if options.pathological_rate and random() < options.pathological_rate:
+            pending += rng.randrange(1 << 20, MAX_DELTA)
+        gap = 1 + int(random() * longest)
+        size = 1 + int(random() * options.polyphony)
+        if size == 1:
+            chord = [36 + int(random() * 60)]
+            lengths = [(1 + int(random() * gap)) * sixteenth]
+        else:
+            chord = rng.sample(range(36, 96), size)
+            lengths = sorted((1 + int(random() * gap)) * sixteenth for _ in chord)
+        # long rests can add up past MAX_DELTA; split them over channel_prefix events
+        while pending > MAX_DELTA:
+            yield CHANNEL_PREFIX, 0, MAX_DELTA
+            pending -= MAX_DELTA
+        for note in chord:
+            yield NOTE_ON, note, pending
+            pending = 0
+        now = 0
+        for note, length in zip(chord, lengths):
+            yield NOTE_OFF, note, length - now
+            now = length
+        pending = gap * sixteenth - now
+
+
+def _write_chunk(fp: IO[bytes], data: bytes) -> int:
+    return fp.write(b'MTrk' + struct.pack('>L', len(data))) + fp.write(data)
+
+
+def _vlq(value: int) -> bytes:
+    """a MIDI variable length quantity"""
+    if value < 0x80:
+        return _SMALL_VLQ[value]
+    out = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        out.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(out)
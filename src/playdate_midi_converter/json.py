@@ -1,16 +1,133 @@
 from dataclasses import is_dataclass, asdict
 from json import JSONEncoder, dumps
-from typing import Any
+from typing import Any, IO, Iterable, Iterator
+
+
+# precomputed text of the small integers note triples are made of
+_INT_TEXT = {i: str(i) for i in range(256)}
 
 
 def song_to_json(song, pretty: bool = False):
-    if pretty:
-        seps = (', ', ': ')
-        indent = 4
-    else:
-        seps = (',', ':')
-        indent = None
-    return dumps(song, cls=SongEncoder, separators=seps, indent=indent)
+    return ''.join(SongStreamEncoder(pretty).iterencode(song))
+
+
+def join_ints(values: Iterable[int], separator: str = ',') -> str:
+    """joins ints as JSON text, looking up the text of values below 256"""
+    if iter(values) is values:
+        # iterators can only be read once, keep the values for the fallback
+        values = list(values)
+    try:
+        return separator.join(map(_INT_TEXT.__getitem__, values))
+    except KeyError:
+        return separator.join(map(str, values))
+
+
+def write_songs(songs: Iterable, fp: IO[str], pretty: bool = False):
+    """
+    stream songs into fp chunk by chunk, producing the same text as song_to_json
+    songs may be a generator, so only one song is held at a time
+    """
+    for chunk in SongStreamEncoder(pretty).iterencode(songs):
+        fp.write(chunk)
+
+
+class SongStreamEncoder(object):
+    """
+    encodes songs with the layout of song_to_json without building the document;
+    list items are written as they are produced and tracks stream their notes
+    through json_chunks()
+    """
+    def __init__(self, pretty: bool = False):
+        super().__init__()
+        if pretty:
+            self.item_separator, self.key_separator, self.indent = ', ', ': ', 4
+        else:
+            self.item_separator, self.key_separator, self.indent = ',', ':', None
+    
+    def iterencode(self, o: Any, level: int = 0) -> Iterator[str]:
+        if isinstance(o, (str, int, float, bool)) or o is None:
+            yield dumps(o)
+        elif isinstance(o, dict):
+            yield from self._iterencode_items(((k, v) for k, v in o.items()), level, '{', '}')
+        elif isinstance(o, (list, tuple)) or hasattr(o, '__next__'):
+            yield from self._iterencode_items(o, level, '[', ']')
+        elif hasattr(o, 'json_chunks'):
+            yield from self._iterencode_chunks(o, level)
+        elif isinstance(o, JsonEncodable):
+            yield from self.iterencode(o.json_default(), level)
+        else:
+            raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+    
+    def _iterencode_items(self, items: Iterable, level: int, opening: str, closing: str) -> Iterator[str]:
+        inner_indent, separator, outer_indent = self._layout(level)
+        first = True
+        for item in items:
+            yield opening + inner_indent if first else separator
+            if closing == '}':
+                key, item = item
+                yield dumps(key) + self.key_separator
+            yield from self.iterencode(item, level + 1)
+            first = False
+        yield opening + closing if first else outer_indent + closing
+    
+    def _iterencode_chunks(self, o: Any, level: int) -> Iterator[str]:
+        # song imports this module, so it can only be imported here
+        from playdate_midi_converter.song import Track, SparseNotes
+        inner_indent, separator, outer_indent = self._layout(level)
+        if isinstance(o, Track) and o.channel is not None and isinstance(o.notes, SparseNotes):
+            chunks = _sparse_text_chunks(o.notes, separator)
+        else:
+            chunks = (join_ints(chunk, separator) for chunk in o.json_chunks())
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            yield ('[' + inner_indent if first else separator) + chunk
+            first = False
+        yield '[]' if first else outer_indent + ']'
+    
+    def _layout(self, level: int):
+        """returns the indent after an opening bracket, the item separator and the indent before the closing one"""
+        if self.indent is None:
+            return '', self.item_separator, ''
+        inner_indent = '\n' + ' ' * (self.indent * (level + 1))
+        outer_indent = '\n' + ' ' * (self.indent * level)
+        return inner_indent, self.item_separator + inner_indent, outer_indent
+
+
+def _sparse_text_chunks(notes, separator: str, chunk_steps: int = 4096) -> Iterator[str]:
+    """
+    writes sparse notes as JSON text straight from their onsets;
+    runs of rests are repeated copies of one precomputed rest text
+    """
+    rest = separator.join(('0', '0', '0'))
+    rest_run = rest + separator
+    
+    def segments():
+        step = 0
+        for onset, value, octave, length in notes.onsets():
+            yield from _rest_segments(onset - step)
+            yield separator.join((_INT_TEXT[value], _INT_TEXT[octave], _INT_TEXT[length] if length < 256 else str(length))), 1
+            step = onset + 1
+        yield from _rest_segments(len(notes) - step)
+    
+    def _rest_segments(count):
+        while count > 0:
+            steps = min(count, chunk_steps)
+            yield rest_run * (steps - 1) + rest, steps
+            count -= steps
+    
+    pieces = []
+    piece_steps = 0
+    for text, steps in segments():
+        pieces.append(text)
+        piece_steps += steps
+        if piece_steps >= chunk_steps:
+            yield separator.join(pieces)
+            pieces = []
+            piece_steps = 0
+    if pieces:
+        yield separator.join(pieces)
 
 
 class SongEncoder(JSONEncoder):
@@ -0,0 +1,205 @@
+"""
+JSON lines conversion protocol
+
+Reads one job per line and writes one result per line, in input order, so a
+single process can handle all the conversions of a build step over a pipe.
+A job is a JSON object with either a "path" or base64 "data" and optionally
+"id", "name", "map" (string or list of strings), "fill" (true or false),
+"max_notes", "engine" and "reader":
+
+    {"id": 1, "path": "music/title.mid", "map": "1=sine,2=square"}
+
+Each result echoes the id (the line number when the job has none) with either
+the converted "song" or an "error":
+
+    {"id":1,"song":{"id":0,"bpm":120,"name":"title","notes":[...],...}}
+    {"id":2,"error":"MThd not found. Probably not a MIDI file"}
+"""
+import base64
+import json
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from io import BytesIO
+from logging import ERROR
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Any, IO, Iterable, Optional, Tuple
+
+from playdate_midi_converter import worker
+from playdate_midi_converter.batch import convert_mapped
+from playdate_midi_converter.json import SongStreamEncoder
+from playdate_midi_converter.midi import Midi, ENGINES, READERS
+from playdate_midi_converter.server import ConvertOptions
+from playdate_midi_converter.ui.rules.channel_mapping import RulesChannelMapper
+
+
+@dataclass
+class JsonlJob:
+    id: Any
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+    options: ConvertOptions = None
+
+
+def parse_job(line: str, number: int, defaults: ConvertOptions = None) -> JsonlJob:
+    """
+    parse one input line; raises ValueError with the job's id in .args[1] when it is invalid
+    a job's map applies on top of the rules file of the defaults; jobs with a path are
+    named after the file, unless the defaults give a name
+    """
+    defaults = defaults or ConvertOptions()
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e!s}", number)
+    if not isinstance(request, dict):
+        raise ValueError("A job must be a JSON object.", number)
+    job_id = request.get('id', number)
+    try:
+        if ('path' in request) == ('data' in request):
+            raise ValueError("A job needs either 'path' or 'data'.")
+        maps = request.get('map', defaults.maps)
+        if isinstance(maps, str):
+            maps = [maps]
+        options = replace(defaults, maps=list(maps))
+        if 'path' in request:
+            path, data = str(request['path']), None
+            if defaults.name == ConvertOptions.name:
+                options.name = os.path.splitext(os.path.basename(path))[0]
+        else:
+            path, data = None, base64.b64decode(request['data'], validate=True)
+        if 'name' in request:
+            options.name = str(request['name'])
+        if 'max_notes' in request:
+            options.max_notes = int(request['max_notes'])
+        if 'fill' in request:
+            if not isinstance(request['fill'], bool):
+                raise ValueError("'fill' must be true or false.")
+            options.fill = request['fill']
+        options.engine = request.get('engine', options.engine)
+        options.reader = request.get('reader', options.reader)
+        if options.engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{options.engine}'. Expected one of: {', '.join(ENGINES)}.")
+        if options.reader not in READERS:
+            raise ValueError(f"Unknown reader '{options.reader}'. Expected one of: {', '.join(READERS)}.")
+        _channel_mapper(tuple(options.maps), options.rules, options.fill)
+    except Exception as e:
+        raise ValueError(f"{e!s}" or e.__class__.__name__, job_id)
+    return JsonlJob(job_id, path, data, options)
+
+
+def convert_job(job: JsonlJob) -> Tuple[bool, str]:
+    """convert one job to whether it succeeded and its result line; errors are returned instead of raised"""
+    options = job.options
+    try:
+        file = job.path if job.data is None else BytesIO(job.data)
+        midi = Midi(worker.context, file, clip=True, max_notes=options.max_notes, engine=options.engine, reader=options.reader)
+        song = convert_mapped(midi, _channel_mapper(tuple(options.maps), options.rules, options.fill))
+        song.name = options.name
+        return True, ''.join(SongStreamEncoder().iterencode({'id': job.id, 'song': song}))
+    except Exception as e:
+        return False, error_line(job.id, f"{e!s}" or e.__class__.__name__)
+
+
+@lru_cache(maxsize=64)
+def _channel_mapper(maps: Tuple[str, ...], rules: Optional[str], fill: bool) -> RulesChannelMapper:
+    """the mapper for a job's mapping options, so each process reads a rules file only once"""
+    return RulesChannelMapper.from_options(maps, rules, fill=fill)
+
+
+def error_line(job_id: Any, message: str) -> str:
+    return json.dumps({'id': job_id, 'error': message}, separators=(',', ':'))
+
+
+def run_jsonl(lines: Iterable[str], out: IO[str], workers: int = 1, log_level: int = ERROR, cache_dir: str = None, defaults: ConvertOptions = None) -> int:
+    """
+    convert every job in lines, writing one result line per job to out in input order
+    with workers > 1 up to workers * 4 jobs are in flight, and each result is written
+    as soon as every earlier one has been; returns the number of failed jobs
+    """
+    failures = 0
+    if workers <= 1:
+        worker.init_worker(log_level, cache_dir, midi_cache=True)
+        for number, line in enumerate(lines, 1):
+            result = _submit(None, line, number, defaults)
+            failures += _write(out, result)
+        return failures
+
+    # a bounded queue keeps the input from running ahead of the output
+    pending = Queue(maxsize=workers * 4)
+    # set, with the error, when the writer stops early, e.g. on a broken pipe
+    failed = Event()
+    errors = []
+
+    def writer():
+        nonlocal failures
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                failures += _write(out, _result(*item) if isinstance(item[1], Future) else item)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=worker.init_worker, initargs=(log_level, cache_dir, None, True)) as pool:
+        thread = Thread(target=writer, daemon=True)
+        thread.start()
+        try:
+            for number, line in enumerate(lines, 1):
+                item = _submit(pool, line, number, defaults)
+                if item is not None and not _put(pending, item, failed):
+                    break
+        finally:
+            _put(pending, None, failed)
+            thread.join()
+            if errors:
+                pool.shutdown(wait=False, cancel_futures=True)
+    if errors:
+        raise errors[0]
+    return failures
+
+
+def _put(pending: Queue, item, failed: Event) -> bool:
+    """put item on the queue, unless the writer has failed; returns whether it was put"""
+    while not failed.is_set():
+        try:
+            pending.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _submit(pool: Optional[ProcessPoolExecutor], line: str, number: int, defaults: ConvertOptions):
+    """the result of convert_job, or the job id and a future of it; None for blank lines"""
+    if not line.strip():
+        return None
+    try:
+        job = parse_job(line, number, defaults)
+    except ValueError as e:
+        return False, error_line(e.args[1], e.args[0])
+    if pool is None:
+        return convert_job(job)
+    return job.id, pool.submit(convert_job, job)
+
+
+def _result(job_id: Any, future: Future) -> Tuple[bool, str]:
+    try:
+        return future.result()
+    except Exception as e:
+        # the worker itself failed, e.g. it was killed
+        return False, error_line(job_id, f"{e!s}" or e.__class__.__name__)
+
+
+def _write(out: IO[str], result: Optional[Tuple[bool, str]]) -> int:
+    """write a result line, returning 1 for failed jobs"""
+    if result is None:
+        return 0
+    ok, line = result
+    out.write(line + '\n')
+    out.flush()
+    return 0 if ok else 1
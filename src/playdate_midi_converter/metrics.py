@@ -0,0 +1,121 @@
+"""
+Conversion metrics
+
+A MetricsRegistry holds the counters and histograms that conversions update
+when Context.metrics is set. Worker processes send snapshot() of their
+registry back with each result and the parent merge()s them, so a batch or a
+server ends up with the totals of all of its workers. Registries export as
+JSON or in the Prometheus text format.
+"""
+import json
+from bisect import bisect_left
+from threading import Lock
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+
+PROMETHEUS_PREFIX = 'playdate_pulp_midi_'
+
+_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_STEPS_BUCKETS = (16, 64, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# name -> (help, histogram buckets or None for counters)
+METRICS: Dict[str, Tuple[str, Optional[Sequence[float]]]] = {
+    'files_converted_total': ("Files converted, including conversion cache hits.", None),
+    'conversion_errors_total': ("Files that failed to convert.", None),
+    'messages_scanned_total': ("MIDI messages scanned while decoding.", None),
+    'notes_emitted_total': ("Note onsets written to songs.", None),
+    'rest_steps_emitted_total': ("Empty steps written to songs, for rests and sustained notes.", None),
+    'polyphonic_notes_dropped_total': ("note_on events dropped because another note was still playing.", None),
+    'truncations_total': ("Tracks cut short by max_notes.", None),
+    'conversion_cache_hits_total': ("Track indexes and songs read from the conversion cache.", None),
+    'midi_cache_hits_total': ("Files whose parsed state came from the in-memory MIDI cache.", None),
+    'conversion_seconds': ("Time spent in Midi.convert per file.", _SECONDS_BUCKETS),
+    'conversion_steps': ("Steps of all tracks per converted file.", _STEPS_BUCKETS),
+}
+
+
+class MetricsRegistry(object):
+    counters: Dict[str, float]
+    histograms: Dict[str, Dict[str, Any]]
+
+    def __init__(self):
+        super().__init__()
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        """add value to the histogram name; its buckets come from METRICS"""
+        buckets = METRICS[name][1]
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                # the last count is the +Inf bucket
+                histogram = self.histograms[name] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+            histogram['counts'][bisect_left(buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """a JSON-compatible copy of every metric"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: dict(h, counts=list(h['counts'])) for name, h in self.histograms.items()},
+            }
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """add a snapshot, e.g. from a worker process, to this registry"""
+        with self._lock:
+            for name, value in snapshot.get('counters', {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot.get('histograms', {}).items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = dict(other, counts=list(other['counts']))
+                    continue
+                if histogram['buckets'] != other['buckets']:
+                    raise ValueError(f"Histogram {name} has different buckets.")
+                histogram['counts'] = [a + b for a, b in zip(histogram['counts'], other['counts'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+
+    def to_json(self, pretty: bool = False) -> str:
+        return json.dumps(self.snapshot(), indent=2 if pretty else None)
+
+    def to_prometheus(self) -> str:
+        """every metric in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            _describe(lines, name, 'counter')
+            lines.append(f"{PROMETHEUS_PREFIX}{name} {value}")
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            _describe(lines, name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f"{PROMETHEUS_PREFIX}{name}_bucket{{le=\"{bound}\"}} {cumulative}")
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_sum {histogram['sum']}")
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_count {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename: str, format: str = 'json'):
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus() if format == 'prometheus' else self.to_json(pretty=True) + '\n')
+
+
+def _describe(lines: list, name: str, kind: str):
+    help_text = METRICS.get(name, ('', None))[0]
+    if help_text:
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}{name} {help_text}")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+
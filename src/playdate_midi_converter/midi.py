@@ -1,163 +1,349 @@
-from typing import Union, List, Tuple, IO
-from io import IOBase
+from itertools import chain
+from time import perf_counter
+from logging import Logger, INFO
+from dataclasses import replace
+from typing import Union, Iterable, List, Optional, Tuple, IO
+from io import IOBase, BytesIO
 # import logging
 
 from mido.midifiles.midifiles import MidiFile
-from mido.midifiles.tracks import MidiTrack
-from mido.midifiles.units import tempo2bpm
 
-from playdate_midi_converter.song import Song, Track, Note
+from playdate_midi_converter.analysis import MidiAnalysis, TrackInfo, analyze, index, CHANNEL_PREFIX, NOTE_ON, NOTE_OFF
+from playdate_midi_converter.smf import SmfError, index_smf, read_header, read_smf
+from playdate_midi_converter.song import Song, Track, SparseNotes
 from playdate_midi_converter.config import Context
 
 
+ENGINES = ('python', 'numpy')
+READERS = ('smf', 'mido')
+# per-file ceilings, so one bad file can't exhaust a worker's memory; 0 turns one off
+MAX_FILE_BYTES = 64 * 1024 * 1024
+MAX_STEPS = 1 << 24
+
+
+class LimitError(ValueError):
+    """a file over one of the per-file ceilings"""
+
+
 class Midi(object):
     context: Context
+    logger: Logger
     
-    def __init__(self, context: Context, file: Union[str, IOBase, MidiFile, IO], *, clip: bool = True, max_notes: int = 512):
+    def __init__(self, context: Context, file: Union[str, IOBase, MidiFile, IO], *, clip: bool = True, max_notes: int = 512, engine: str = 'python', reader: str = 'smf',
+                 max_bytes: int = MAX_FILE_BYTES, max_steps: int = MAX_STEPS):
         super().__init__()
         self.context = context
+        # one logger for every file; a logger per filename would live in the manager for good
+        self.logger = context.get_logger(self.__class__.__name__)
         self.max_notes = max_notes
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}'. Expected one of: {', '.join(ENGINES)}.")
+        if reader not in READERS:
+            raise ValueError(f"Unknown reader '{reader}'. Expected one of: {', '.join(READERS)}.")
+        self.engine = engine
+        self.reader = reader
+        self._clip = clip
+        self._analysis = None
+        self._index = None
+        self._base = None
+        self._data = None
+        self._raw = None
+        self._midi_cache_key = None
+        if engine == 'numpy':
+            # numpy is optional and only needed for this engine
+            from playdate_midi_converter import numpy_engine
+            self._numpy_engine = numpy_engine
         if isinstance(file, MidiFile):
+            self.filename = file.filename
             self._base = file
             self._base.clip = clip
-        elif isinstance(file, str):
-            self._base = MidiFile(filename=file, clip=clip)
         else:
-            self._base = MidiFile(file=file, clip=clip)
+            midi_cache = context.midi_cache
+            if isinstance(file, str):
+                self.filename = file
+                if midi_cache is not None:
+                    self._midi_cache_key = midi_cache.path_key(file, clip)
+                    if self._restore():
+                        return
+                with open(file, 'rb') as f:
+                    data = self._read_limited(f)
+                # the raw bytes also key the conversion cache
+                self._raw = data
+            else:
+                self.filename = None
+                data = self._read_limited(file)
+                self._raw = data
+                if midi_cache is not None:
+                    self._midi_cache_key = midi_cache.content_key(data, clip)
+                    if self._restore():
+                        return
+            if reader == 'mido':
+                self._base = MidiFile(filename=self.filename, file=BytesIO(data), clip=clip)
+            else:
+                self._read(data)
+    
+    def _read_limited(self, f: IO[bytes]) -> bytes:
+        """read all of f, but no more than max_bytes"""
+        if self.max_bytes <= 0:
+            return f.read()
+        data = f.read(self.max_bytes + 1)
+        if len(data) > self.max_bytes:
+            raise LimitError(f"{self._source}: file is larger than {self.max_bytes} bytes.")
+        return data
+    
+    def _restore(self) -> bool:
+        """take the index and analysis from the in-memory MIDI cache, if it has this file"""
+        entry = self.context.midi_cache.get(self._midi_cache_key)
+        if entry is None:
+            return False
+        self._index, self._analysis = entry
+        if self.context.metrics is not None:
+            self.context.metrics.inc('midi_cache_hits_total')
+        return True
+    
+    def _read(self, data: bytes):
+        """keep the raw file for the built-in SMF reader, which decodes it on demand"""
+        self._data = data
+        try:
+            read_header(data)
+        except SmfError as e:
+            self._fall_back(e)
+    
+    def _fall_back(self, error: SmfError):
+        """hand the raw file to mido when the built-in SMF reader can't handle it"""
+        self.logger.debug("%s: SMF reader failed (%s), falling back to mido", self._source, error)
+        data, self._data = self._data, None
+        self._base = MidiFile(filename=self.filename, file=BytesIO(data), clip=self._clip)
     
     @property
-    def logger(self):
-        return self.context.get_logger(f"{self.__class__.__name__}[{self._base.filename}]")
+    def _source(self) -> str:
+        """the file name for log messages"""
+        return self.filename if self.filename is not None else '<stream>'
     
-    def convert(self) -> Song:
-        bpm, sixteenth_note_default = self._evaluate_notes(self._base)
-        tracks = self._midi_tracks(self._base, sixteenth_note_default, max_notes=self.max_notes)
-        return Song(id=0, bpm=bpm, name=self._base.filename, tracks=tracks)
+    def track_index(self) -> List[TrackInfo]:
+        """
+        every track's number, name and event counts, without decoding note events
+        quick enough to map tracks to channels before converting
+        """
+        if self._index is None:
+            key = self._cache_key('index')
+            if key is not None:
+                self._index = self.context.cache.get_index(key)
+                if self._index is not None:
+                    if self.context.metrics is not None:
+                        self.context.metrics.inc('conversion_cache_hits_total')
+                    return self._index
+            if self._data is not None:
+                try:
+                    self._index = index_smf(self._data, clip=self._clip)
+                except SmfError as e:
+                    self._fall_back(e)
+            if self._index is None:
+                self._index = index(self._base)
+            if key is not None:
+                self.context.cache.put_index(key, self._index)
+        return self._index
     
-    def _evaluate_notes(self, midi: MidiFile) -> Tuple[int, int]:
-        """evaluate notes to get the note/bpm multiplier"""
-        bpm = self._midi_bpm(midi)
-        sixteenth_note_default = midi.ticks_per_beat / 4
-        
-        # define variables
-        lowestTime = None
-        
-        # find the lowest non-zero note time
-        # does not account for polyphonic / concurrent note events
-        for track in midi.tracks:
-            for msg in track:
-                if not msg.is_meta and msg.time > 0:
-                    if lowestTime is None or lowestTime > msg.time:
-                        lowestTime = msg.time
-        
-        # since 16th notes are the lowest available Pulp audio resolution, adjust song translation accordingly
-        if lowestTime > sixteenth_note_default:
-            # update BPM and sixteenth note time if lowest note value is an even multiple
-            if lowestTime % sixteenth_note_default == 0:
-                # slow the BPM to account for the decrease in resolution - this allows more song time
-                bpm = round(bpm / (lowestTime / sixteenth_note_default))
-                sixteenth_note_default = lowestTime
-        elif lowestTime < sixteenth_note_default:
-            # update BPM and sixteenth note time if lowest note value is an even multiple
-            if sixteenth_note_default % lowestTime == 0:
-                # increase the BPM to account for the increase in resolution - will result in less song time
-                bpm = round(bpm * (sixteenth_note_default / lowestTime))
-                sixteenth_note_default = lowestTime
+    def analyze(self, tracks: Iterable[int] = None) -> MidiAnalysis:
+        """
+        the single-pass analysis of the file, computed once and reused
+        tracks limits the note events to those track numbers; the SMF reader
+        then doesn't decode the others at all, unless the whole file is going
+        into the in-memory MIDI cache
+        """
+        if tracks is not None:
+            tracks = set(tracks)
+            if self._analysis is None and self._data is not None and self._midi_cache_key is None:
+                try:
+                    return read_smf(self._data, clip=self._clip, index=self._index, tracks=tracks)
+                except SmfError as e:
+                    self._fall_back(e)
+            analysis = self.analyze()
+            return replace(analysis, tracks=[track for track in analysis.tracks if track.number in tracks])
+        if self._analysis is None:
+            if self._data is not None:
+                try:
+                    self._analysis = read_smf(self._data, clip=self._clip, index=self._index)
+                except SmfError as e:
+                    self._fall_back(e)
+            if self._analysis is None:
+                self._analysis = analyze(self._base)
+            if self._midi_cache_key is not None:
+                self.context.midi_cache.put(self._midi_cache_key, self.track_index(), self._analysis)
+        return self._analysis
+    
+    def convert(self, tracks: Iterable[int] = None) -> Song:
+        """
+        convert the file to a Song
+        tracks limits note extraction to those track numbers, e.g. the ones
+        mapped to a channel; the other tracks are left out of the song
+        """
+        started = perf_counter()
+        key = self._cache_key('song', tracks=None if tracks is None else sorted(set(tracks)), max_notes=self.max_notes, engine=self.engine)
+        if key is not None:
+            song = self.context.cache.get_song(key)
+            if song is not None:
+                self.logger.debug("%s: Using cached conversion.", self._source)
+                song.name = self.filename
+                if self.context.metrics is not None:
+                    self.context.metrics.inc('conversion_cache_hits_total')
+                    self._count_song(song, started)
+                return song
         
-        return bpm, sixteenth_note_default
-    
-    def _midi_bpm(self, midi_file: MidiFile, default: int = 80) -> int:
-        """convert tempo to BPM"""
-        # set default BPM just in case
-        bpm = default
-        for msg in midi_file.tracks[0]:
-            if msg.type == "set_tempo":
-                bpm = round(tempo2bpm(msg.tempo))
-                return bpm
-        return bpm
-    
-    def _midi_tracks(self, midi_file: MidiFile, sixteenth_note_default: int, max_notes: int = 0) -> List[Track]:
+        stage = self.context.stage
+        with stage('parse'):
+            analysis = self.analyze(tracks)
+        with stage('analyze'):
+            bpm, sixteenth_note_default = self._evaluate_notes(analysis)
+        with stage('extract'):
+            tracks = self._midi_tracks(analysis, sixteenth_note_default, max_notes=self.max_notes)
+        song = Song(id=0, bpm=bpm, name=self.filename, tracks=tracks)
+        if key is not None:
+            self.context.cache.put_song(key, song)
+        if self.context.metrics is not None:
+            self.context.metrics.inc('messages_scanned_total', analysis.message_count)
+            self._count_song(song, started)
+        return song
+    
+    def _count_song(self, song: Song, started: float):
+        metrics = self.context.metrics
+        metrics.inc('files_converted_total')
+        metrics.observe('conversion_seconds', perf_counter() - started)
+        metrics.observe('conversion_steps', sum(track.ticks for track in song.tracks))
+    
+    def _count_notes(self, notes: SparseNotes, dropped: int):
+        """add one track's notes to the conversion metrics"""
+        metrics = self.context.metrics
+        metrics.inc('notes_emitted_total', notes.note_count)
+        metrics.inc('rest_steps_emitted_total', len(notes) - notes.note_count)
+        metrics.inc('polyphonic_notes_dropped_total', dropped)
+        if notes.truncated:
+            metrics.inc('truncations_total')
+    
+    def _cache_key(self, kind: str, **options) -> Optional[str]:
+        """conversion cache key, or None when there is no cache or no raw file to hash"""
+        if self.context.cache is None or self._raw is None:
+            return None
+        return self.context.cache.key(self._raw, kind=kind, clip=self._clip, **options)
+    
+    def _evaluate_notes(self, analysis: MidiAnalysis) -> Tuple[int, int]:
+        """evaluate notes to get the note/bpm multiplier"""
+        return analysis.grid()
+    
+    def _midi_tracks(self, analysis: MidiAnalysis, sixteenth_note_default: int, max_notes: int = 0) -> List[Track]:
         """
-        collects track data from MIDI file
+        collects track data from the analysed MIDI file
         and stores it in a list of MIDI Tracks
         """
         newTrackCollection = []
-        for i, track in enumerate(midi_file.tracks):
-            if i != 0:
-                notes = self._get_notes(track, sixteenth_note_default, max_notes)
-                newTrack = Track(i, track.name, notes, len(notes))
+        log_tracks = self.logger.isEnabledFor(INFO)
+        steps = 0
+        for track in analysis.tracks:
+            if track.number != 0:
+                notes = self._get_notes(track.events, sixteenth_note_default, max_notes)
+                # rests take no memory until the song is serialized, so this stops a file before that
+                steps += len(notes)
+                if 0 < self.max_steps < steps:
+                    raise LimitError(f"{self._source}: song is longer than {self.max_steps} steps.")
+                newTrack = Track(track.number, track.name, notes, len(notes))
                 newTrackCollection.append(newTrack)
-                self.logger.info("Track {}: {}".format(i, track.name))
+                if log_tracks:
+                    self.logger.info("%s: Track %d: %s", self._source, track.number, track.name)
         return newTrackCollection
     
-    def _get_notes(self, midi_track: MidiTrack, sixteenth_note_default: int, max_notes: int = 0) -> List[Note]:
-        """get all the notes from a midi track"""
-        convertedMIDINotes = []
+    def _get_notes(self, events: List[Tuple[int, int, int]], sixteenth_note_default: int, max_notes: int = 0) -> SparseNotes:
+        """get all the notes from a track's (kind, note, time) events"""
+        if self.engine == 'numpy':
+            stats = {}
+            total, *onsets = self._numpy_engine.get_onsets(events, sixteenth_note_default, max_notes, stats)
+            notes = SparseNotes.from_onsets(total, *(a.tolist() for a in onsets))
+            notes.truncated = stats['truncated']
+            if notes.truncated:
+                self.logger.info("%s: Max song length reached. Truncating song.", self._source)
+            if self.context.metrics is not None:
+                self._count_notes(notes, stats['dropped'])
+            return notes
+        
+        convertedMIDINotes = SparseNotes()
         noteCounter = 0
         deltaTime = 0
         lastNote = 0
         lastNoteIndex = 0
-        for msg in midi_track:
+        dropped = 0
+        truncated = False
+        events = iter(events)
+        for kind, note, time in events:
             
             if 0 < max_notes <= noteCounter:
                 # hit the max JSON song length - need to truncate
-                self.logger.info("Max song length reached. Truncating song.")
+                truncated = truncated or self._steps_left(chain([(kind, note, time)], events), lastNote, deltaTime, sixteenth_note_default)
                 break
             
-            if msg.is_meta:  # capture channel_prefix for delayed start time
-                if msg.type == "channel_prefix" and msg.time > 0:
-                    restEvents = int(msg.time / sixteenth_note_default)
-                    while restEvents != 0:
-                        # add empty events for rest positions
-                        new_json_note = Note()
-                        convertedMIDINotes.append(new_json_note)
-                        noteCounter += 1
-                        restEvents -= 1
+            if kind == CHANNEL_PREFIX:  # capture channel_prefix for delayed start time
+                if time > 0:
+                    restEvents = int(time / sixteenth_note_default)
+                    if 0 < max_notes < noteCounter + restEvents:
+                        restEvents = max_notes - noteCounter
+                        truncated = True
+                    # add empty events for rest positions
+                    convertedMIDINotes.extend_rests(restEvents)
+                    noteCounter += restEvents
                 continue
             
-            if msg.type == "note_on":
+            if kind == NOTE_ON:
                 # handling polyphony - not supported on playdate
                 if lastNote != 0:
-                    deltaTime += msg.time
+                    deltaTime += time
+                    dropped += 1
                 else:
-                    if msg.time != 0:
-                        restEvents = int(msg.time / sixteenth_note_default)
-                        while restEvents != 0:
-                            # add empty events for rest positions
-                            new_json_note = Note()
-                            convertedMIDINotes.append(new_json_note)
-                            noteCounter += 1
-                            restEvents -= 1
+                    if time != 0:
+                        restEvents = int(time / sixteenth_note_default)
+                        if 0 < max_notes < noteCounter + restEvents:
+                            restEvents = max_notes - noteCounter
+                            truncated = True
+                        # add empty events for rest positions
+                        convertedMIDINotes.extend_rests(restEvents)
+                        noteCounter += restEvents
+                        if 0 < max_notes <= noteCounter:
+                            # the rest used up the song, there is no room for the note
+                            truncated = True
+                            break
                     
-                    lastNote = msg.note
+                    lastNote = note
                     deltaTime = 0
-                    noteValue = self._note_value(msg.note)
-                    noteOctave = self._note_octave(msg.note)
+                    noteValue = self._note_value(note)
+                    noteOctave = self._note_octave(note)
                     noteLen = 1
-                    new_json_note = Note(noteValue, noteOctave, noteLen)
-                    convertedMIDINotes.append(new_json_note)
+                    convertedMIDINotes.append(noteValue, noteOctave, noteLen)
                     lastNoteIndex = noteCounter
                     noteCounter += 1
             
-            elif msg.type == "note_off" and lastNote == msg.note:
+            elif kind == NOTE_OFF and lastNote == note:
                 lastNote = 0
-                deltaTime += msg.time
+                deltaTime += time
                 
                 noteLen = self._note_length(deltaTime, sixteenth_note_default)
-                convertedMIDINotes[lastNoteIndex].length = noteLen
+                convertedMIDINotes.set_length(lastNoteIndex, noteLen)
                 
                 if deltaTime / sixteenth_note_default >= 2:
                     # add empty events for sustained note durations
                     restEvents = int(deltaTime / sixteenth_note_default)
                     restEvents -= 1  # accounts for note data already stored above
+                    if 0 < max_notes < noteCounter + restEvents:
+                        restEvents = max_notes - noteCounter
+                        truncated = True
                     
-                    while restEvents != 0:
-                        # add empty events for rest positions
-                        new_json_note = Note()
-                        convertedMIDINotes.append(new_json_note)
-                        noteCounter += 1
-                        restEvents -= 1
+                    # add empty events for rest positions
+                    convertedMIDINotes.extend_rests(restEvents)
+                    noteCounter += restEvents
         
+        convertedMIDINotes.truncated = truncated
+        if truncated:
+            self.logger.info("%s: Max song length reached. Truncating song.", self._source)
+        if self.context.metrics is not None:
+            self._count_notes(convertedMIDINotes, dropped)
         return convertedMIDINotes
     
     def _note_value(self, note_int: int) -> int:
@@ -174,6 +360,22 @@ class Midi(object):
             noteOctave = 0  # anything below octave 0 is set to 0
         return noteOctave
     
+    def _steps_left(self, events: Iterable[Tuple[int, int, int]], last_note: int, delta_time: int, sixteenth_note_default: int) -> bool:
+        """whether any of the events left once the song is full would have added a step"""
+        for kind, note, time in events:
+            if kind == CHANNEL_PREFIX:
+                if int(time / sixteenth_note_default) > 0:
+                    return True
+            elif kind == NOTE_ON:
+                if last_note == 0:
+                    return True
+                delta_time += time
+            elif kind == NOTE_OFF and last_note == note:
+                if (delta_time + time) / sixteenth_note_default >= 2:
+                    return True
+                last_note = 0
+        return False
+    
     def _note_length(self, note_time: int, sixteenth_note_default: int) -> int:
         """gets JSON note length (in 16ths) from MIDI note time"""
         if note_time < sixteenth_note_default:
@@ -0,0 +1,136 @@
+"""
+NumPy step-grid engine
+
+Produces the same notes as Midi._get_notes, but quantizes all events in bulk
+and places the note onsets with array operations instead of stepping through
+every 16th. Only the monophony bookkeeping (which note_on starts a note and
+which note_off ends it) is a scalar pass; it runs once per message, not once
+per step.
+"""
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from playdate_midi_converter.analysis import CHANNEL_PREFIX, NOTE_ON, NOTE_OFF
+
+# roles of the events that emit steps
+_REST = 0
+_ONSET = 1
+_RELEASE = 2
+
+
+def get_onsets(events: Iterable[Tuple[int, int, int]], sixteenth_note_default: int, max_notes: int = 0, stats: dict = None) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    get the total step count and the step, value, octave and length
+    of every note onset for one track's (kind, note, time) events
+    stats, if given, gets the number of polyphonic note_on events dropped as 'dropped'
+    and whether max_notes cut any steps off the track as 'truncated'
+    """
+    roles, ticks, notes, links, dropped = _resolve_roles(events)
+    if stats is not None:
+        stats['dropped'] = 0
+        stats['truncated'] = False
+    if not roles:
+        return _no_onsets()
+    roles = np.array(roles, dtype=np.int8)
+    ticks = np.array(ticks, dtype=np.int64)
+    notes = np.array(notes, dtype=np.int64)
+    links = np.array(links, dtype=np.int64)
+
+    # quantize every event at once - same float division as int(time / sixteenth_note_default)
+    sixteenths = ticks / sixteenth_note_default
+    steps = sixteenths.astype(np.int64)
+    is_onset = roles == _ONSET
+    is_release = roles == _RELEASE
+    sustain = np.where(sixteenths >= 2, steps - 1, 0)
+    emitted = np.where(is_release, sustain, steps + is_onset)
+    counter = np.cumsum(emitted)
+    before = counter - emitted
+    if stats is not None and dropped:
+        # like the scalar loop, only count the ones reached before max_notes stopped it
+        dropped = np.array(dropped, dtype=np.int64)
+        reached = np.where(dropped > 0, counter[dropped - 1], 0)
+        stats['dropped'] = len(dropped) if max_notes <= 0 else int(np.count_nonzero(reached < max_notes))
+
+    if stats is not None:
+        stats['truncated'] = 0 < max_notes < int(counter[-1])
+    if max_notes > 0:
+        # events starting past max_notes are never reached, and the rests and
+        # sustains of the last one stop at max_notes
+        processed = int(np.searchsorted(before, max_notes, side='left'))
+        if processed == 0:
+            return _no_onsets()
+        ticks, notes, links, steps, before, counter, is_onset, is_release = (
+            a[:processed] for a in (ticks, notes, links, steps, before, counter, is_onset, is_release))
+        # an onset whose rest used up the song is dropped
+        is_onset = is_onset & (before + steps < max_notes)
+        counter = np.minimum(counter, max_notes)
+    total = int(counter[-1])
+
+    onset_notes = notes[is_onset]
+    positions = (before + steps)[is_onset]
+    values = onset_notes % 12 + 1
+    octaves = np.where(onset_notes >= 24, onset_notes // 12 - 2, 0)
+    lengths = np.ones(len(positions), dtype=np.int64)
+
+    release_lengths = np.where(ticks < sixteenth_note_default, 1, steps)[is_release]
+    release_links = links[is_release]
+    linked = release_links >= 0
+    # onset ordinal of every event, to turn event links into onset indices
+    ordinals = np.cumsum(is_onset) - 1
+    lengths[ordinals[release_links[linked]]] = release_lengths[linked]
+
+    if not linked.all():
+        # a note_off matching before any note_on sets the length of step 0
+        if np.any(before[is_release][~linked] == 0):
+            raise IndexError("list index out of range")
+        positions = np.concatenate(([0], positions))
+        values = np.concatenate(([0], values))
+        octaves = np.concatenate(([0], octaves))
+        lengths = np.concatenate((release_lengths[~linked][-1:], lengths))
+    return total, positions, values, octaves, lengths
+
+
+def _no_onsets():
+    empty = np.zeros(0, dtype=np.int64)
+    return 0, empty, empty, empty, empty
+
+
+def _resolve_roles(events: Iterable[Tuple[int, int, int]]):
+    """
+    scalar pass mirroring the monophony handling of Midi._get_notes
+    returns the role, tick count, note and onset link of each emitting event, and
+    for every dropped polyphonic note_on the number of emitting events before it
+    """
+    roles, ticks, notes, links, dropped = [], [], [], [], []
+    last_note = 0
+    delta_time = 0
+    last_onset = -1
+    for kind, note, time in events:
+        if kind == CHANNEL_PREFIX:
+            if time > 0:
+                roles.append(_REST)
+                ticks.append(time)
+                notes.append(0)
+                links.append(-1)
+        elif kind == NOTE_ON:
+            # handling polyphony - not supported on playdate
+            if last_note != 0:
+                delta_time += time
+                dropped.append(len(roles))
+            else:
+                last_note = note
+                delta_time = 0
+                last_onset = len(roles)
+                roles.append(_ONSET)
+                ticks.append(time)
+                notes.append(note)
+                links.append(-1)
+        elif kind == NOTE_OFF and last_note == note:
+            last_note = 0
+            delta_time += time
+            roles.append(_RELEASE)
+            ticks.append(delta_time)
+            notes.append(0)
+            links.append(last_onset)
+    return roles, ticks, notes, links, dropped
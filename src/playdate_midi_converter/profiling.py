@@ -0,0 +1,156 @@
+"""
+Stage profiling
+
+Conversions mark their stages with Context.stage(name):
+
+    open       reading the file (Midi())
+    parse      decoding its events (Midi.analyze)
+    analyze    the tempo and note grid (Midi._evaluate_notes)
+    extract    the notes of every track (Midi._get_notes)
+    map        the channel mapping, including the track index it is made on
+    serialize  writing the JSON
+
+A stage hook is any object with a stage(name) context manager, added to
+Context.hooks. Without hooks Context.stage returns a shared no-op context, so
+the stage marks can stay in production code. StageProfiler is the hook behind
+--profile; profile_calls and StackSampler wrap cProfile and a sampling
+profiler that writes folded stacks for flame graph tools.
+"""
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Sequence
+
+
+STAGES = ('open', 'parse', 'analyze', 'extract', 'map', 'serialize')
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.001
+
+NO_STAGE = nullcontext()
+
+
+def enter_stages(hooks: Sequence, name: str):
+    """the stage(name) context of every hook, as one context"""
+    if len(hooks) == 1:
+        return hooks[0].stage(name)
+    return _all_stages(hooks, name)
+
+
+@contextmanager
+def _all_stages(hooks: Sequence, name: str) -> Iterator[None]:
+    with ExitStack() as stack:
+        for hook in hooks:
+            stack.enter_context(hook.stage(name))
+        yield
+
+
+class StageProfiler(object):
+    """stage hook totalling the calls and time of every stage"""
+    started: float
+    totals: Dict[str, List]
+
+    def __init__(self):
+        super().__init__()
+        self.started = time.perf_counter()
+        # stage name -> [calls, seconds]
+        self.totals = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += time.perf_counter() - started
+
+    def format_table(self) -> str:
+        """calls, milliseconds and share of the time since the profiler was made, per stage"""
+        wall = time.perf_counter() - self.started
+        names = [name for name in STAGES if name in self.totals] + sorted(set(self.totals) - set(STAGES))
+        lines = [f"{'stage':<10}{'calls':>7}{'ms':>11}{'%':>7}", '-' * 35]
+        staged = 0.0
+        for name in names:
+            calls, seconds = self.totals[name]
+            staged += seconds
+            lines.append(f"{name:<10}{calls:>7}{seconds * 1000:>11.2f}{_share(seconds, wall):>7.1f}")
+        other = max(0.0, wall - staged)
+        lines.append(f"{'other':<10}{'':>7}{other * 1000:>11.2f}{_share(other, wall):>7.1f}")
+        lines.append(f"{'total':<10}{'':>7}{wall * 1000:>11.2f}{100.0:>7.1f}")
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile_calls(filename: str) -> Iterator[cProfile.Profile]:
+    """run the body under cProfile and dump its stats to filename, for pstats or snakeviz"""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
+
+
+class StackSampler(object):
+    """
+    samples the stack of one thread every interval seconds from a background thread
+    write() saves the samples as folded stacks ("outer;inner count" lines), the
+    input format of flamegraph.pl, speedscope and inferno
+    """
+    interval: float
+    samples: Counter
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = SAMPLE_INTERVAL):
+        super().__init__()
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # the sampler needs the GIL at least once per interval to keep up
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval / 2))
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            sys.setswitchinterval(self._switch_interval)
+
+    def write(self, filename: str):
+        with open(filename, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def __enter__(self) -> 'StackSampler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+
+def _share(seconds: float, wall: float) -> float:
+    return seconds / wall * 100 if wall > 0 else 0.0
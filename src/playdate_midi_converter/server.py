@@ -0,0 +1,256 @@
+"""
+Conversion server
+
+Keeps a pool of worker processes with the converter already imported and
+warmed up, behind a small HTTP server on localhost. Editors and build tools
+POST the bytes of a MIDI file to /convert and get the Pulp JSON back, without
+paying for interpreter startup on every conversion:
+
+    POST /convert?name=Title&map=1=sine,2=square&max_notes=512
+
+Options are query parameters: name, max_notes, map (repeatable), fill,
+pretty, engine and reader. Without any map the tracks fill the channels in
+order, like the batch command. request_conversion is a matching client.
+If a worker process dies, the request gets a 500 and the pool is replaced
+with new warmed-up workers.
+
+GET /metrics returns the conversion metrics of all workers in the Prometheus
+text format, or as JSON with ?format=json.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from logging import ERROR
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+from playdate_midi_converter import worker
+from playdate_midi_converter.batch import convert_mapped
+from playdate_midi_converter.config import Config, Context
+from playdate_midi_converter.json import song_to_json
+from playdate_midi_converter.metrics import MetricsRegistry
+from playdate_midi_converter.midi import Midi, ENGINES, READERS
+from playdate_midi_converter.ui.rules.channel_mapping import RulesChannelMapper
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# refuse anything bigger than this many bytes of MIDI
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# format 1 file with one empty track, converted once by every worker on startup
+_WARM_UP_MIDI = b'MThd\x00\x00\x00\x06\x00\x01\x00\x01\x01\xe0MTrk\x00\x00\x00\x04\x00\xff\x2f\x00'
+
+class ServerError(Exception):
+    pass
+
+
+@dataclass
+class ConvertOptions:
+    name: str = 'song'
+    max_notes: int = 512
+    maps: List[str] = field(default_factory=list)
+    # mapping rules file; only ever set from the command line, never by a request
+    rules: Optional[str] = None
+    fill: bool = False
+    pretty: bool = False
+    engine: str = 'python'
+    reader: str = 'smf'
+
+    @classmethod
+    def from_query(cls, query: str) -> 'ConvertOptions':
+        """parse the query string of a request; raises ValueError for bad options"""
+        params = parse_qs(query, keep_blank_values=True)
+        unknown = set(params) - {'name', 'max_notes', 'map', 'fill', 'pretty', 'engine', 'reader'}
+        if unknown:
+            raise ValueError(f"Unknown option(s): {', '.join(sorted(unknown))}")
+        options = cls(maps=params.get('map', []))
+        if 'name' in params:
+            options.name = params['name'][-1]
+        if 'max_notes' in params:
+            options.max_notes = int(params['max_notes'][-1])
+        options.fill = _flag(params, 'fill')
+        options.pretty = _flag(params, 'pretty')
+        options.engine = params.get('engine', [options.engine])[-1]
+        options.reader = params.get('reader', [options.reader])[-1]
+        if options.engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{options.engine}'. Expected one of: {', '.join(ENGINES)}.")
+        if options.reader not in READERS:
+            raise ValueError(f"Unknown reader '{options.reader}'. Expected one of: {', '.join(READERS)}.")
+        # fail on bad mappings here rather than in a worker
+        RulesChannelMapper.from_options(options.maps, fill=options.fill)
+        return options
+
+    def to_query(self) -> str:
+        params = [('name', self.name), ('max_notes', self.max_notes)]
+        params += [('map', m) for m in self.maps]
+        params += [(flag, '1') for flag in ('fill', 'pretty') if getattr(self, flag)]
+        params += [('engine', self.engine), ('reader', self.reader)]
+        return urlencode(params)
+
+
+def _flag(params, name: str) -> bool:
+    return params.get(name, ['0'])[-1].lower() in ('', '1', 'true', 'yes')
+
+
+def _error_detail(e: Exception) -> str:
+    if isinstance(e, EOFError) and not e.args:
+        return "unexpected end of data"
+    return f"{e!s}" or e.__class__.__name__
+
+
+def convert_bytes(data: bytes, options: ConvertOptions) -> str:
+    """convert one MIDI file's bytes to Pulp JSON, in a worker process"""
+    midi = Midi(worker.context, BytesIO(data), clip=True, max_notes=options.max_notes, engine=options.engine, reader=options.reader)
+    song = convert_mapped(midi, RulesChannelMapper.from_options(options.maps, options.rules, fill=options.fill))
+    song.name = options.name
+    return song_to_json([song], options.pretty)
+
+
+def convert_measured(data: bytes, options: ConvertOptions) -> Tuple[str, Dict[str, Any]]:
+    """convert_bytes, plus a snapshot of the metrics of this conversion"""
+    worker.context.metrics.reset()
+    return convert_bytes(data, options), worker.context.metrics.snapshot()
+
+
+class ConversionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    pool: ProcessPoolExecutor
+    context: Context
+
+    def __init__(self, address, pool: ProcessPoolExecutor, context: Context, start_pool: Callable[[], ProcessPoolExecutor] = None):
+        """start_pool, if given, starts the pool that replaces a broken one"""
+        # set before binding, which closes the server if it fails
+        self.pool = pool
+        self.context = context
+        self._start_pool = start_pool
+        self._pool_lock = Lock()
+        super().__init__(address, ConversionRequestHandler)
+
+    def replace_pool(self, broken: ProcessPoolExecutor):
+        """swap a pool that a dead worker broke for a new one, once however many requests saw it break"""
+        with self._pool_lock:
+            if self.pool is broken and self._start_pool is not None:
+                self.context.get_logger(self.__class__.__name__).error("A worker process died, restarting the workers.")
+                broken.shutdown(wait=False)
+                self.pool = self._start_pool()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    server: ConversionServer
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/health':
+            self._reply(200, b'ok', 'text/plain')
+        elif url.path == '/metrics':
+            metrics = self.server.context.metrics
+            if parse_qs(url.query).get('format', [''])[-1] == 'json':
+                self._reply(200, metrics.to_json().encode('utf-8'), 'application/json')
+            else:
+                self._reply(200, metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self._reply(404, b'not found', 'text/plain')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            self._reply(404, b'not found', 'text/plain')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._reply(411, b'Content-Length required', 'text/plain')
+            return
+        if length < 0:
+            # rfile.read(-1) would wait for the client to close the connection
+            self.close_connection = True
+            self._reply(400, b'invalid Content-Length', 'text/plain')
+            return
+        if length > MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self._reply(413, b'MIDI file too large', 'text/plain')
+            return
+        data = self.rfile.read(length)
+        try:
+            options = ConvertOptions.from_query(url.query)
+        except Exception as e:
+            self._reply(400, f"{e!s}".encode('utf-8'), 'text/plain')
+            return
+        pool = self.server.pool
+        try:
+            result, snapshot = pool.submit(convert_measured, data, options).result()
+        except BrokenProcessPool:
+            # not the file's fault as far as anyone can tell, so not a 422
+            self.server.context.metrics.inc('conversion_errors_total')
+            self.server.replace_pool(pool)
+            self._reply(500, b'conversion worker died', 'text/plain')
+            return
+        except Exception as e:
+            self.server.context.metrics.inc('conversion_errors_total')
+            self._reply(422, f"invalid MIDI file: {_error_detail(e)}".encode('utf-8'), 'text/plain')
+            return
+        self.server.context.metrics.merge(snapshot)
+        self._reply(200, result.encode('utf-8'), 'application/json')
+
+    def _reply(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.context.get_logger(self.__class__.__name__).info(format, *args)
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, workers: int = 1, log_level: int = ERROR, cache_dir: str = None, ready=None):
+    """
+    serve conversions until interrupted
+    ready, if given, is called with the server once it is listening
+    """
+    context = Context(Config(), log_level=log_level, metrics=MetricsRegistry())
+    start_pool = partial(start_workers, max(1, workers), log_level, cache_dir)
+    # the server shuts the pool down when it closes
+    with ConversionServer((host, port), start_pool(), context, start_pool) as server:
+        if ready is not None:
+            ready(server)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def start_workers(workers: int, log_level: int = ERROR, cache_dir: str = None) -> ProcessPoolExecutor:
+    """a pool of conversion workers, every one started and warmed up before it returns"""
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=worker.init_worker, initargs=(log_level, cache_dir, None, True, True))
+    list(pool.map(_warm_up, range(workers)))
+    return pool
+
+
+def request_conversion(data: bytes, url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout: float = 30, **options) -> str:
+    """client for serve: convert MIDI bytes on a running server and return the Pulp JSON"""
+    query = ConvertOptions(**options).to_query()
+    request = Request(f"{url}/convert?{query}", data=data, method='POST', headers={'Content-Type': 'audio/midi'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return response.read().decode('utf-8')
+    except HTTPError as e:
+        raise ServerError(f"{e.code}: {e.read().decode('utf-8', 'replace')}")
+
+
+def _warm_up(_) -> int:
+    convert_bytes(_WARM_UP_MIDI, ConvertOptions())
+    return os.getpid()
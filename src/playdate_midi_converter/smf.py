@@ -0,0 +1,242 @@
+"""
+Lightweight Standard MIDI File reader
+
+Walks the MTrk chunks of a file directly instead of building a mido message
+for every event. Only what conversion needs is kept: note_on, note_off and
+channel_prefix events as compact (kind, note, time) tuples, the track names,
+the first set_tempo of track 0 and the smallest non-zero delta of any non-meta
+event. Everything else is skipped over by its length. index_smf walks the
+same bytes without collecting events, for a quick list of the tracks.
+
+Anything this reader does not handle exactly like mido (malformed chunks,
+running status into sysex, data bytes above 127 without clipping, ...)
+raises SmfError, so callers can fall back to mido.
+"""
+import struct
+from typing import Container, Iterator, List, Tuple
+
+from playdate_midi_converter.analysis import MidiAnalysis, TrackEvents, TrackInfo, CHANNEL_PREFIX, NOTE_ON, NOTE_OFF
+
+
+# same limit as mido
+MAX_MESSAGE_LENGTH = 1000000
+
+# data bytes after the status byte of each channel message, by high nibble
+_CHANNEL_DATA_LENGTH = (0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 2, 2, 1, 1, 2)
+# data bytes after the status byte of the system messages mido accepts in files
+_SYSTEM_DATA_LENGTH = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
+
+_META = 0xFF
+_META_TRACK_NAME = 0x03
+_META_CHANNEL_PREFIX = 0x20
+_META_SET_TEMPO = 0x51
+
+
+class SmfError(Exception):
+    pass
+
+
+def index_smf(data: bytes, clip: bool = True) -> List[TrackInfo]:
+    """
+    scan every track for its name, event and note counts without collecting its events
+    checks the file as strictly as read_smf does, so a file that indexes will also read
+    """
+    data = bytes(data)
+    infos = []
+    for number, start, end in _chunks(data):
+        infos.append(_read_track(data, start, end, number, clip))
+    return infos
+
+
+def read_smf(data: bytes, clip: bool = True, index: List[TrackInfo] = None, tracks: Container[int] = None) -> MidiAnalysis:
+    """
+    decode the note and tempo events of a Standard MIDI File into a MidiAnalysis
+    an index from index_smf saves finding the track chunks again (one without
+    chunk offsets, as summarized from mido, is ignored)
+    tracks limits decoding to those track numbers; the other tracks are left out,
+    but still count towards the tempo and lowest delta (for free when indexed)
+    """
+    data = bytes(data)
+    ticks_per_beat = read_header(data)[1]
+    if index is None or any(info.offset is None for info in index):
+        chunks = ((number, start, end, None) for number, start, end in _chunks(data))
+    else:
+        chunks = ((info.number, info.offset + 8, info.offset + 8 + info.size, info) for info in index)
+    analysis = MidiAnalysis(ticks_per_beat)
+    for number, start, end, info in chunks:
+        if tracks is None or number in tracks:
+            events = []
+            info = _read_track(data, start, end, number, clip, events)
+            analysis.tracks.append(TrackEvents(number, info.name, events))
+        elif info is None:
+            info = _read_track(data, start, end, number, clip)
+        if number == 0:
+            analysis.tempo = info.tempo
+        if info.min_delta is not None and (analysis.lowest_time is None or analysis.lowest_time > info.min_delta):
+            analysis.lowest_time = info.min_delta
+        analysis.message_count += info.event_count
+    return analysis
+
+
+def read_header(data: bytes) -> Tuple[int, int, int]:
+    """the track count, ticks per beat and offset of the first track chunk"""
+    if data[:4] != b'MThd':
+        raise SmfError("MThd not found. Probably not a MIDI file")
+    try:
+        header_size, _, track_count, ticks_per_beat = struct.unpack_from('>Lhhh', data, 4)
+    except struct.error:
+        raise SmfError("MIDI file header too short")
+    if header_size < 6:
+        raise SmfError("MIDI file header too short")
+    return track_count, ticks_per_beat, 8 + header_size
+
+
+def _chunks(data: bytes) -> Iterator[Tuple[int, int, int]]:
+    """the number, data start and data end of every track chunk"""
+    track_count, _, pos = read_header(data)
+    for number in range(track_count):
+        try:
+            name, size = struct.unpack_from('>4sL', data, pos)
+        except struct.error:
+            raise SmfError("file ends before the last track")
+        if name != b'MTrk':
+            raise SmfError("no MTrk header at start of track")
+        start, pos = pos + 8, pos + 8 + size
+        if pos > len(data):
+            raise SmfError("track chunk runs past the end of the file")
+        yield number, start, pos
+
+
+def _read_track(data: bytes, pos: int, end: int, number: int, clip: bool, events: list = None) -> TrackInfo:
+    """walk one track chunk, appending its note events to events when given"""
+    info = TrackInfo(number, '', offset=pos - 8, size=end - pos)
+    collect = events is not None
+    append = events.append if collect else None
+    name = None
+    tempo = None
+    min_delta = None
+    message_count = 0
+    note_count = 0
+    last_status = None
+    try:
+        while pos < end:
+            # variable length delta time
+            byte = data[pos]
+            pos += 1
+            delta = byte & 0x7F
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                delta = (delta << 7) | (byte & 0x7F)
+
+            status = data[pos]
+            pos += 1
+            message_count += 1
+
+            if status == _META:
+                meta_type = data[pos]
+                byte = data[pos + 1]
+                pos += 2
+                length = byte & 0x7F
+                while byte & 0x80:
+                    byte = data[pos]
+                    pos += 1
+                    length = (length << 7) | (byte & 0x7F)
+                if length > MAX_MESSAGE_LENGTH:
+                    raise SmfError(f"Message length {length} exceeds maximum length {MAX_MESSAGE_LENGTH}")
+                if pos + length > len(data):
+                    raise SmfError("meta message runs past the end of the file")
+                if meta_type == _META_CHANNEL_PREFIX:
+                    if length < 1:
+                        raise SmfError("empty channel_prefix")
+                    if collect:
+                        append((CHANNEL_PREFIX, 0, delta))
+                elif meta_type == _META_TRACK_NAME:
+                    if name is None:
+                        name = data[pos:pos + length].decode('latin1')
+                elif meta_type == _META_SET_TEMPO:
+                    if length < 3:
+                        raise SmfError("short set_tempo")
+                    if tempo is None:
+                        tempo = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+                pos += length
+                continue
+
+            if status < 0x80:
+                # running status - the byte just read is the first data byte
+                if last_status is None:
+                    raise SmfError("running status without last_status")
+                first = status
+                status = last_status
+            else:
+                # meta messages don't set running status, everything else does
+                last_status = status
+                first = None
+
+            if delta > 0 and (min_delta is None or min_delta > delta):
+                min_delta = delta
+
+            kind = status >> 4
+            if kind < 0xF:
+                length = _CHANNEL_DATA_LENGTH[kind]
+                if first is None:
+                    first = data[pos]
+                    pos += 1
+                length -= 1
+                if length and data[pos] > 0x7F and not clip:
+                    raise SmfError("data byte must be in range 0..127")
+                pos += length
+                if kind == 0x9 or kind == 0x8:
+                    if first > 0x7F:
+                        if not clip:
+                            raise SmfError("data byte must be in range 0..127")
+                        first = 0x7F
+                    if kind == 0x9:
+                        note_count += 1
+                    if collect:
+                        append((NOTE_ON if kind == 0x9 else NOTE_OFF, first, delta))
+                elif first > 0x7F and not clip:
+                    raise SmfError("data byte must be in range 0..127")
+            elif status == 0xF0 or status == 0xF7:
+                if first is not None:
+                    raise SmfError("running status sysex")
+                byte = data[pos]
+                pos += 1
+                length = byte & 0x7F
+                while byte & 0x80:
+                    byte = data[pos]
+                    pos += 1
+                    length = (length << 7) | (byte & 0x7F)
+                if length > MAX_MESSAGE_LENGTH:
+                    raise SmfError(f"Message length {length} exceeds maximum length {MAX_MESSAGE_LENGTH}")
+                payload = data[pos:pos + length]
+                if payload[-1:] == b'\xf7':
+                    payload = payload[:-1]
+                if max(payload, default=0) > 0x7F:
+                    # mido rejects these even when clipping
+                    raise SmfError("sysex data byte must be in range 0..127")
+                pos += length
+            elif status in _SYSTEM_DATA_LENGTH:
+                length = _SYSTEM_DATA_LENGTH[status]
+                if first is not None:
+                    if length == 0:
+                        raise SmfError(f"running status for 0x{status:02x}")
+                    length -= 1
+                if not clip and any(b > 0x7F for b in data[pos:pos + length]):
+                    raise SmfError("data byte must be in range 0..127")
+                pos += length
+            else:
+                raise SmfError(f"undefined status byte 0x{status:02x}")
+    except IndexError:
+        raise SmfError("file ends inside a track")
+
+    if pos != end:
+        # mido would carry on reading past the chunk; leave that to mido
+        raise SmfError("track data overruns its chunk")
+
+    info.name = name or ''
+    info.tempo = tempo
+    info.min_delta = min_delta
+    info.event_count = message_count
+    info.note_count = note_count
+    return info
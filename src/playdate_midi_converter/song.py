@@ -1,6 +1,8 @@
+from array import array
+from bisect import bisect_left
 from dataclasses import dataclass, field
 from enum import auto, IntEnum
-from typing import Iterable, List, Hashable
+from typing import Iterable, Iterator, List, Hashable, Mapping, Optional, Sequence, Union
 from itertools import chain
 
 from playdate_midi_converter.json import JsonEncodable
@@ -32,6 +34,22 @@ class Song(JsonEncodable):
             'splits': self.splits,
             'loopFrom': self.loop_from,
         }
+    
+    def map_channels(self, track_mappings: Mapping['Track', Optional['Channel']]):
+        """assign tracks to channels and fill unused channels with empty tracks"""
+        channels = list(Channel)
+        tracks = list()
+        for track, channel in track_mappings.items():
+            if channel is None:  # Ignored
+                continue
+            tracks.append(track)
+            track.channel = channel
+            channels.remove(channel)
+        for channel in channels:
+            empty_track = Track(0, '', [], channel=channel)
+            tracks.append(empty_track)
+        tracks.sort(key=lambda t: t.channel)
+        self.tracks = tracks
 
 
 @dataclass
@@ -51,9 +69,20 @@ class Track(JsonEncodable, Hashable):
     def json_default(self):
         if self.channel is None:
             return []
+        elif isinstance(self.notes, JsonEncodable):
+            return self.notes.json_default()
         else:
             return list(chain(*map(lambda n: n.json_default(), self.notes)))
     
+    def json_chunks(self, chunk_steps: int = 4096) -> Iterator[List[int]]:
+        """json_default() in pieces of at most chunk_steps steps, for streaming writers"""
+        if self.channel is None:
+            return
+        if isinstance(self.notes, (NoteBuffer, SparseNotes)):
+            yield from self.notes.json_chunks(chunk_steps)
+        else:
+            yield self.json_default()
+    
     def __str__(self):
         return f"{self.number} : {self.name}"
 
@@ -68,6 +97,212 @@ class Note(JsonEncodable):
         return [self.value, self.octave, self.length]
 
 
+class NoteBuffer(Sequence, JsonEncodable):
+    """
+    compact track notes stored as flat value/octave/length triples in an array
+    items are only turned into Note objects when they are accessed
+    """
+    def __init__(self, data: Iterable[int] = (), typecode: str = 'B'):
+        super().__init__()
+        self._data = array(typecode)
+        for value in data:
+            self._append_value(value)
+    
+    @classmethod
+    def frombytes(cls, raw: bytes, typecode: str = 'B') -> 'NoteBuffer':
+        buffer = cls(typecode=typecode)
+        buffer._data.frombytes(raw)
+        return buffer
+    
+    @property
+    def data(self) -> array:
+        return self._data
+    
+    def append(self, value: int, octave: int, length: int):
+        try:
+            self._data.extend((value, octave, length))
+        except OverflowError:
+            self._widen()
+            self._data.extend((value, octave, length))
+    
+    def extend_rests(self, count: int):
+        """append count empty (0, 0, 0) steps"""
+        self._data.frombytes(bytes(3 * count * self._data.itemsize))
+    
+    def set_length(self, index: int, length: int):
+        try:
+            self._data[3 * index + 2] = length
+        except OverflowError:
+            self._widen()
+            self._data[3 * index + 2] = length
+    
+    def json_default(self):
+        return self._data.tolist()
+    
+    def json_chunks(self, chunk_steps: int = 4096) -> Iterator[List[int]]:
+        for start in range(0, len(self._data), 3 * chunk_steps):
+            yield self._data[start:start + 3 * chunk_steps].tolist()
+    
+    def __len__(self) -> int:
+        return len(self._data) // 3
+    
+    def __getitem__(self, index: Union[int, slice]) -> Union['Note', 'NoteBuffer']:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return NoteBuffer(chain(*(self[i].json_default() for i in range(start, stop, step))), self._data.typecode)
+            result = NoteBuffer(typecode=self._data.typecode)
+            result._data = self._data[3 * start:3 * stop]
+            return result
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("note index out of range")
+        return Note(*self._data[3 * index:3 * index + 3])
+    
+    def __iter__(self) -> Iterator['Note']:
+        data = iter(self._data)
+        return (Note(*triple) for triple in zip(data, data, data))
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, NoteBuffer):
+            return self._data.tolist() == other._data.tolist()
+        return NotImplemented
+    
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self)} notes)"
+    
+    def _append_value(self, value: int):
+        try:
+            self._data.append(value)
+        except OverflowError:
+            self._widen()
+            self._data.append(value)
+    
+    def _widen(self):
+        # note lengths of long sustained notes may not fit a byte
+        self._data = array('L', self._data)
+
+
+class SparseNotes(Sequence, JsonEncodable):
+    """
+    track notes stored as onsets only - (step, value, octave, length) - plus the
+    total number of 16th steps; the rest-filled dense sequence is only built
+    when it is serialized or iterated, so memory follows the number of notes
+    """
+    # whether max_notes cut the track short
+    truncated = False
+    
+    def __init__(self):
+        super().__init__()
+        self._steps = array('L')
+        self._values = array('B')
+        self._octaves = array('B')
+        self._lengths = array('L')
+        self._length = 0
+    
+    @classmethod
+    def from_onsets(cls, length: int, steps: Iterable[int], values: Iterable[int], octaves: Iterable[int], lengths: Iterable[int]) -> 'SparseNotes':
+        notes = cls()
+        notes._steps.extend(steps)
+        notes._values.extend(values)
+        notes._octaves.extend(octaves)
+        notes._lengths.extend(lengths)
+        notes._length = length
+        return notes
+    
+    @property
+    def note_count(self) -> int:
+        return len(self._steps)
+    
+    def onsets(self) -> Iterator[tuple]:
+        """iterate (step, value, octave, length) of every note"""
+        return zip(self._steps, self._values, self._octaves, self._lengths)
+    
+    def append(self, value: int, octave: int, length: int):
+        self._steps.append(self._length)
+        self._values.append(value)
+        self._octaves.append(octave)
+        self._lengths.append(length)
+        self._length += 1
+    
+    def extend_rests(self, count: int):
+        """append count empty (0, 0, 0) steps"""
+        self._length += count
+    
+    def set_length(self, index: int, length: int):
+        if self._steps and self._steps[-1] == index:
+            self._lengths[-1] = length
+            return
+        if not 0 <= index < self._length:
+            raise IndexError("note index out of range")
+        i = bisect_left(self._steps, index)
+        if i < len(self._steps) and self._steps[i] == index:
+            self._lengths[i] = length
+        else:
+            # a length on an empty step turns it into a (0, 0, length) note
+            self._steps.insert(i, index)
+            self._values.insert(i, 0)
+            self._octaves.insert(i, 0)
+            self._lengths.insert(i, length)
+    
+    def dense(self, start: int = 0, stop: int = None) -> NoteBuffer:
+        """materialize the rest-filled value/octave/length triples of steps start to stop"""
+        if stop is None or stop > self._length:
+            stop = self._length
+        first, last = bisect_left(self._steps, start), bisect_left(self._steps, stop)
+        typecode = 'B' if max(self._lengths[first:last], default=0) <= 0xFF else 'L'
+        dense = NoteBuffer(typecode=typecode)
+        dense.extend_rests(max(stop - start, 0))
+        data = dense.data
+        for i in range(first, last):
+            offset = 3 * (self._steps[i] - start)
+            data[offset] = self._values[i]
+            data[offset + 1] = self._octaves[i]
+            data[offset + 2] = self._lengths[i]
+        return dense
+    
+    def json_default(self):
+        return self.dense().json_default()
+    
+    def json_chunks(self, chunk_steps: int = 4096) -> Iterator[List[int]]:
+        for start in range(0, self._length, chunk_steps):
+            yield self.dense(start, start + chunk_steps).json_default()
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def __getitem__(self, index: Union[int, slice]) -> Union['Note', NoteBuffer]:
+        if isinstance(index, slice):
+            return self.dense()[index]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("note index out of range")
+        i = bisect_left(self._steps, index)
+        if i < len(self._steps) and self._steps[i] == index:
+            return Note(self._values[i], self._octaves[i], self._lengths[i])
+        return Note()
+    
+    def __iter__(self) -> Iterator['Note']:
+        step = 0
+        for onset, value, octave, length in self.onsets():
+            for step in range(step, onset):
+                yield Note()
+            yield Note(value, octave, length)
+            step = onset + 1
+        for step in range(step, self._length):
+            yield Note()
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, SparseNotes):
+            return self._length == other._length and list(self.onsets()) == list(other.onsets())
+        return NotImplemented
+    
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.note_count} notes in {self._length} steps)"
+
+
 class Channel(IntEnum):
     SINE = auto()
     SQUARE = auto()
@@ -0,0 +1,85 @@
+"""
+Chrome trace events
+
+Tracer is a stage hook that records every stage (see profiling) as a complete
+event of the Chrome trace-event format, read by chrome://tracing, Perfetto
+and speedscope. Batch workers each trace their own conversions and send the
+events back with every result; the parent adds them to its own tracer, so
+one file shows how the files of a batch were spread over the workers:
+
+    {"traceEvents": [{"name": "parse", "cat": "stage", "ph": "X",
+                      "ts": 1700000000000000, "dur": 1200, "pid": 4242, "tid": 4242}, ...]}
+
+Timestamps are microseconds of wall clock time, kept monotonic within each
+process, so events from different processes line up.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List
+
+
+class Tracer(object):
+    events: List[Dict[str, Any]]
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+        self._pid = os.getpid()
+        self._named = set()
+        # aligns the monotonic clock with the wall clock once per process
+        self._offset = time.time_ns() - time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def now(self) -> int:
+        """the current time in trace microseconds"""
+        return (time.perf_counter_ns() + self._offset) // 1000
+
+    @contextmanager
+    def span(self, name: str, category: str = 'stage', **args) -> Iterator[None]:
+        """record the body as one complete event"""
+        started = self.now()
+        try:
+            yield
+        finally:
+            event = {
+                'name': name, 'cat': category, 'ph': 'X',
+                'ts': started, 'dur': self.now() - started,
+                'pid': self._pid, 'tid': threading.get_ident(),
+            }
+            if args:
+                event['args'] = args
+            with self._lock:
+                self.events.append(event)
+
+    def stage(self, name: str):
+        return self.span(name)
+
+    def take(self) -> List[Dict[str, Any]]:
+        """remove and return the events recorded so far"""
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def extend(self, events: Iterable[Dict[str, Any]]):
+        """add events recorded by another process"""
+        with self._lock:
+            self.events.extend(events)
+
+    def name_process(self, pid: int, name: str):
+        """label a process in the timeline, once"""
+        with self._lock:
+            if pid in self._named:
+                return
+            self._named.add(pid)
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}})
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def write(self, filename: str):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, separators=(',', ':'))
@@ -8,7 +8,7 @@ from playdate_midi_converter.config import Context
 def choose(context: Context, message, options):
     log = context.get_logger('choose')
     chosen = pick(options, message)
-    log.info(f"{message} : {chosen}")
+    log.info("%s : %s", message, chosen)
     return chosen
 
 
@@ -0,0 +1,117 @@
+import re
+from configparser import ConfigParser
+from typing import Dict, Iterable, List, Mapping, Optional, Pattern, Tuple
+
+from playdate_midi_converter.ui.common.channel_mapping import ChannelMapper, ChannelMappingException
+from playdate_midi_converter.song import Track, Channel
+
+
+IGNORE = 'ignore'
+
+
+def parse_channel(name: str) -> Optional[Channel]:
+    """converts a channel name (e.g. 'sine' or 'Square') to a Channel, 'ignore' to None"""
+    name = name.strip()
+    if name.lower() == IGNORE:
+        return None
+    try:
+        return Channel[name.upper()]
+    except KeyError:
+        raise ChannelMappingException(f"Unknown channel \"{name}\". Expected one of: {', '.join(c.name.lower() for c in Channel)} or {IGNORE}.")
+
+
+def parse_track_map(*specs: str) -> Dict[int, Optional[Channel]]:
+    """parses '--map' style specs such as '1=sine,2=square,3=ignore'"""
+    track_map = {}
+    for spec in specs:
+        for item in filter(None, (i.strip() for i in spec.split(','))):
+            number, sep, channel = item.partition('=')
+            if not sep:
+                raise ChannelMappingException(f"Invalid mapping \"{item}\". Expected TRACK=CHANNEL.")
+            try:
+                track_map[int(number)] = parse_channel(channel)
+            except ValueError:
+                raise ChannelMappingException(f"Invalid track number \"{number}\" in mapping \"{item}\".")
+    return track_map
+
+
+def read_rules(filename: str, encoding: str = 'utf-8') -> Tuple[Dict[int, Optional[Channel]], List[Tuple[str, Optional[Channel]]]]:
+    """
+    reads mapping rules from a config file:
+    
+        [tracks]
+        1 = sine
+        
+        [rule lead]
+        pattern = lead|melody
+        channel = square
+    
+    rule sections are applied in file order
+    """
+    parser = ConfigParser(interpolation=None)
+    if not parser.read(filename, encoding):
+        raise ChannelMappingException(f"Mapping rules file '{filename}' could not be read.")
+    track_map = {}
+    if parser.has_section('tracks'):
+        track_map = parse_track_map(','.join(f"{k}={v}" for k, v in parser.items('tracks')))
+    name_rules = []
+    for section in parser.sections():
+        if not section.startswith('rule'):
+            continue
+        try:
+            name_rules.append((parser[section]['pattern'], parse_channel(parser[section]['channel'])))
+        except KeyError as e:
+            raise ChannelMappingException(f"Rule [{section}] is missing '{e.args[0]}'.")
+    return track_map, name_rules
+
+
+class RulesChannelMapper(ChannelMapper):
+    """
+    maps tracks to channels without user interaction; explicit track numbers
+    win over track-name patterns, and with 'fill' any unmatched tracks take
+    the remaining channels in order
+    """
+    track_map: Dict[int, Optional[Channel]]
+    name_rules: List[Tuple[Pattern, Optional[Channel]]]
+    
+    def __init__(self, track_map: Mapping[int, Optional[Channel]] = None, name_rules: Iterable[Tuple[str, Optional[Channel]]] = (), fill: bool = False):
+        super().__init__()
+        self.track_map = dict(track_map or {})
+        try:
+            self.name_rules = [(re.compile(pattern, re.IGNORECASE), channel) for pattern, channel in name_rules]
+        except re.error as e:
+            raise ChannelMappingException(f"Invalid track name pattern: {e!s}")
+        self.fill = fill
+    
+    @classmethod
+    def from_options(cls, maps: Iterable[str] = (), rules_file: str = None, fill: bool = False) -> 'RulesChannelMapper':
+        track_map, name_rules = {}, []
+        if rules_file is not None:
+            track_map, name_rules = read_rules(rules_file)
+        track_map.update(parse_track_map(*maps))
+        # with nothing to match on, fall back to mapping the tracks in order
+        return cls(track_map, name_rules, fill=fill or not (track_map or name_rules))
+    
+    def tracks_to_channels(self, tracks: List[Track], channels: List[Channel]) -> Mapping[Track, Channel]:
+        channels = channels.copy()
+        results = {}
+        for track in tracks:
+            if track.number in self.track_map:
+                results[track] = self._take(self.track_map[track.number], channels)
+        for track in tracks:
+            if track not in results:
+                for pattern, channel in self.name_rules:
+                    if (channel is None or channel in channels) and pattern.search(track.name):
+                        results[track] = self._take(channel, channels)
+                        break
+        for track in tracks:
+            if track not in results:
+                results[track] = channels.pop(0) if self.fill and channels else None
+        return {track: results[track] for track in tracks}
+    
+    @staticmethod
+    def _take(channel: Optional[Channel], channels: List[Channel]) -> Optional[Channel]:
+        if channel is None or channel not in channels:
+            return None
+        channels.remove(channel)
+        return channel
@@ -0,0 +1,229 @@
+"""
+In-place updates of Pulp songs files
+
+Finds the songs of an existing songs array with a scan that only stops at
+strings and brackets, reading each song's id without decoding its notes. The
+file is scanned chunk by chunk, keeping only the span and id of every song,
+then songs that don't change are copied through in chunks as the exact bytes
+they were. Memory follows the songs being set, not the size of the file, and
+an update costs the conversion of the changed songs plus a copy of the rest.
+"""
+import os
+import re
+from typing import IO, Iterable, List, Mapping, Optional, Tuple
+
+from playdate_midi_converter.json import SongStreamEncoder
+
+
+CHUNK_SIZE = 64 * 1024
+
+# the next string or bracket; numbers, commas and whitespace in between are skipped
+_DELIMITER = re.compile(rb'["\[\]{}]')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_ID_VALUE = re.compile(rb'\s*:\s*(-?\d+)')
+# what an id value may still be while its number runs into the next chunk
+_ID_PREFIX = re.compile(rb'[\s:\-\d]*')
+_WHITESPACE = re.compile(rb'[ \t\r\n]*')
+
+
+class SongsFileError(Exception):
+    pass
+
+
+class _Scanner(object):
+    """the strings and brackets of a file read chunk by chunk; only the unscanned part of a chunk is kept"""
+
+    def __init__(self, f: IO[bytes], chunk_size: int = CHUNK_SIZE):
+        super().__init__()
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = b''
+        # file offset of _buf[0]
+        self._base = 0
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """drop the scanned part of the buffer and read the next chunk; False at the end of the file"""
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._base += self._pos
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def token(self) -> Optional[Tuple[int, bytes]]:
+        """(offset, token) of the next string or bracket, or None at the end of the file"""
+        while True:
+            match = _DELIMITER.search(self._buf, self._pos)
+            if match is None:
+                self._pos = len(self._buf)
+                if not self._fill():
+                    return None
+                continue
+            start = match.start()
+            if match.group() != b'"':
+                self._pos = start + 1
+                return self._base + start, match.group()
+            string = _STRING.match(self._buf, start)
+            if string is None:
+                # the string goes on in the next chunk
+                self._pos = start
+                if not self._fill():
+                    raise SongsFileError(f"Unterminated string at offset {self._base + start}.")
+                continue
+            self._pos = string.end()
+            return self._base + start, string.group()
+
+    def id_value(self) -> Optional[int]:
+        """the number after an "id" key just read, if it has one"""
+        while _ID_PREFIX.match(self._buf, self._pos).end() == len(self._buf) and self._fill():
+            pass
+        match = _ID_VALUE.match(self._buf, self._pos)
+        return int(match.group(1)) if match is not None else None
+
+    def skip_whitespace(self) -> Optional[int]:
+        """offset of the next byte that is not whitespace, or None at the end of the file"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._base + self._pos
+            if not self._fill():
+                return None
+
+
+def scan_songs(f: IO[bytes], chunk_size: int = CHUNK_SIZE) -> Tuple[List[Tuple[int, int, Optional[int]]], int, int]:
+    """
+    locate the songs of the songs array in f, from its current position
+    returns the (start, end, id) byte span of every song and the offsets of the
+    array's opening and closing brackets
+    """
+    scanner = _Scanner(f, chunk_size)
+    opening = scanner.skip_whitespace()
+    token = scanner.token()
+    if token is None or token != (opening, b'['):
+        raise SongsFileError("Expected a JSON array of songs.")
+    spans = []
+    depth = 1
+    start = None
+    song_id = None
+    while True:
+        token = scanner.token()
+        if token is None:
+            raise SongsFileError("The songs array is not closed.")
+        offset, value = token
+        first = value[:1]
+        if first == b'"':
+            if depth == 2 and value == b'"id"' and song_id is None:
+                song_id = scanner.id_value()
+        elif first in b'[{':
+            depth += 1
+            if depth == 2:
+                if first != b'{':
+                    raise SongsFileError(f"Expected a song object at offset {offset}.")
+                start = offset
+                song_id = None
+        else:
+            depth -= 1
+            if depth == 1:
+                spans.append((start, offset + 1, song_id))
+            elif depth == 0:
+                if scanner.skip_whitespace() is not None:
+                    raise SongsFileError("Unexpected data after the songs array.")
+                return spans, opening, offset
+
+
+def update_songs(source: IO[bytes], fp: IO[bytes], songs: Iterable = (), remove: Iterable[int] = (), pretty: bool = False, chunk_size: int = CHUNK_SIZE):
+    """
+    write the songs file source to fp with songs replacing the songs with the
+    same ids, songs with new ids inserted in id order, and the songs with ids
+    in remove left out
+    the other songs, and the whitespace between them, are copied as they are;
+    source must be seekable
+    """
+    spans, opening, closing = scan_songs(source, chunk_size)
+    new_songs = {song.id: song for song in songs}
+    remove = set(remove) - set(new_songs)
+    encoder = SongStreamEncoder(pretty)
+
+    # reuse the file's own separator between songs when adding any
+    if len(spans) > 1:
+        separator = _read(source, spans[0][1], spans[1][0])
+    else:
+        separator = encoder.item_separator.encode('utf-8')
+        if pretty:
+            separator += b'\n' + b' ' * encoder.indent
+
+    inserts = sorted(song_id for song_id in new_songs if song_id not in {span[2] for span in spans})
+    pieces = _merge(spans, new_songs, inserts, remove)
+
+    _copy(source, fp, 0, opening + 1, chunk_size)
+    leading = _read(source, opening + 1, spans[0][0]) if spans else (b'\n' + b' ' * encoder.indent if pretty else b'')
+    trailing = _read(source, spans[-1][1], closing) if spans else (b'\n' if pretty else b'')
+    first = True
+    for piece in pieces:
+        fp.write(leading if first else separator)
+        if isinstance(piece, tuple):
+            _copy(source, fp, piece[0], piece[1], chunk_size)
+        else:
+            for chunk in encoder.iterencode(piece, 1):
+                fp.write(chunk.encode('utf-8'))
+        first = False
+    if not first:
+        fp.write(trailing)
+    _copy(source, fp, closing, None, chunk_size)
+
+
+def update_file(filename: str, songs: Iterable = (), remove: Iterable[int] = (), pretty: bool = False):
+    """update a songs file in place; the file is only replaced once the update is written"""
+    tmp = filename + '.tmp'
+    try:
+        with open(filename, 'rb') as source, open(tmp, 'wb') as f:
+            update_songs(source, f, songs, remove, pretty)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _merge(spans: List[Tuple[int, int, Optional[int]]], new_songs: Mapping, inserts: List[int], remove: Iterable[int]):
+    """the songs to write in order: untouched songs as their (start, end) span, new ones as Song objects"""
+    pending = iter(inserts)
+    insert = next(pending, None)
+    for start, end, song_id in spans:
+        # new ids go before the first song with a larger id
+        while insert is not None and song_id is not None and insert < song_id:
+            yield new_songs[insert]
+            insert = next(pending, None)
+        if song_id in remove:
+            continue
+        if song_id in new_songs:
+            yield new_songs[song_id]
+        else:
+            yield start, end
+    while insert is not None:
+        yield new_songs[insert]
+        insert = next(pending, None)
+
+
+def _read(source: IO[bytes], start: int, end: int) -> bytes:
+    source.seek(start)
+    return source.read(end - start)
+
+
+def _copy(source: IO[bytes], fp: IO[bytes], start: int, end: Optional[int], chunk_size: int = CHUNK_SIZE):
+    """copy the bytes from start to end, or to the end of the file, chunk by chunk"""
+    source.seek(start)
+    remaining = end - start if end is not None else None
+    while remaining is None or remaining > 0:
+        chunk = source.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        fp.write(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
@@ -0,0 +1,36 @@
+"""
+Conversion worker processes
+
+batch, jsonl and serve convert in pools of worker processes. Every worker
+sets up its context, channel mapper and tracer once, in init_worker, and the
+conversion functions read them from this module. Without a pool, init_worker
+sets up the current process the same way.
+"""
+from typing import Optional
+
+from playdate_midi_converter.cache import ConversionCache, MidiCache
+from playdate_midi_converter.config import Config, Context
+from playdate_midi_converter.metrics import MetricsRegistry
+from playdate_midi_converter.tracing import Tracer
+from playdate_midi_converter.ui.common.channel_mapping import ChannelMapper
+
+
+# per-process context, mapper and tracer, set up by init_worker
+context: Optional[Context] = None
+mapper: Optional[ChannelMapper] = None
+tracer: Optional[Tracer] = None
+
+
+def init_worker(log_level: int, cache_dir: str = None, channel_mapper: ChannelMapper = None, midi_cache: bool = False, metrics: bool = False, trace: bool = False):
+    """
+    set up this process for conversions; cache_dir turns on the conversion cache,
+    midi_cache keeps parsed files in memory, metrics and trace record every conversion
+    """
+    global context, mapper, tracer
+    cache = ConversionCache(cache_dir) if cache_dir is not None else None
+    context = Context(Config(), log_level=log_level, cache=cache, midi_cache=MidiCache() if midi_cache else None,
+                      metrics=MetricsRegistry() if metrics else None)
+    mapper = channel_mapper
+    tracer = Tracer() if trace else None
+    if tracer is not None:
+        context.hooks.append(tracer)
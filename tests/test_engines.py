@@ -0,0 +1,39 @@
+import glob
+import os
+from io import BytesIO
+
+import pytest
+
+from playdate_midi_converter.config import Config, Context
+from playdate_midi_converter.generate import GeneratorOptions, generate_bytes
+from playdate_midi_converter.json import song_to_json
+from playdate_midi_converter.midi import Midi
+
+pytest.importorskip('numpy')
+
+DEMO_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'Demo Files', '*.mid')))
+
+GENERATED = [
+    GeneratorOptions(seed=1, tracks=2, notes=300),
+    GeneratorOptions(seed=2, tracks=3, notes=300, polyphony=3, tempo_changes=2),
+    GeneratorOptions(seed=3, tracks=2, notes=200, lead_in=4, rest_rate=0.05, rest_beats=32, ticks_per_beat=96),
+]
+
+
+def _inputs():
+    for path in DEMO_FILES:
+        with open(path, 'rb') as f:
+            yield pytest.param(f.read(), id=os.path.basename(path))
+    for options in GENERATED:
+        yield pytest.param(generate_bytes(options), id=f"generated-{options.seed}")
+
+
+def _convert(data: bytes, engine: str, max_notes: int):
+    song = Midi(Context(Config()), BytesIO(data), max_notes=max_notes, engine=engine).convert()
+    return song_to_json([song]), [track.notes.truncated for track in song.tracks]
+
+
+@pytest.mark.parametrize('max_notes', [0, 1, 37, 512])
+@pytest.mark.parametrize('data', list(_inputs()))
+def test_numpy_engine_matches_python(data, max_notes):
+    assert _convert(data, 'numpy', max_notes) == _convert(data, 'python', max_notes)
@@ -0,0 +1,58 @@
+import glob
+import os
+from io import StringIO
+from json import dumps
+
+import pytest
+
+from playdate_midi_converter.config import Config, Context
+from playdate_midi_converter.json import SongEncoder, song_to_json, write_songs
+from playdate_midi_converter.midi import Midi
+from playdate_midi_converter.song import Channel, Note, NoteBuffer, Song, SparseNotes, Track
+
+DEMO_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'Demo Files', '*.mid')))
+
+
+def _reference(songs, pretty: bool) -> str:
+    """the plain JSONEncoder layout song_to_json has to keep"""
+    if pretty:
+        return dumps(songs, cls=SongEncoder, separators=(', ', ': '), indent=4)
+    return dumps(songs, cls=SongEncoder, separators=(',', ':'))
+
+
+def _demo_songs():
+    songs = []
+    for song_id, path in enumerate(DEMO_FILES):
+        for max_notes in (0, 37):
+            song = Midi(Context(Config()), path, max_notes=max_notes).convert()
+            song.id = song_id
+            song.map_channels({track: channel for track, channel in zip(song.tracks, Channel)})
+            songs.append(song)
+    return songs
+
+
+def _hand_made_song():
+    # long notes don't fit the byte table, and every kind of note container
+    sparse = SparseNotes.from_onsets(9000, [0, 4100, 8999], [1, 2, 3], [4, 5, 6], [300, 1, 70000])
+    tracks = [
+        Track(1, 'sparse', sparse, len(sparse), Channel.SINE),
+        Track(2, 'buffer', NoteBuffer([1, 2, 3, 0, 0, 0, 7, 8, 256]), 3, Channel.SQUARE),
+        Track(3, 'notes', [Note(1, 2, 3), Note()], 2, Channel.NOISE),
+        Track(4, 'unmapped', [Note(1, 2, 3)], 1, None),
+    ]
+    return Song(id=7, bpm=120, name='hand "made"', tracks=tracks, loop_from=2)
+
+
+@pytest.mark.parametrize('pretty', [False, True])
+def test_song_to_json_matches_song_encoder(pretty):
+    songs = _demo_songs() + [_hand_made_song()]
+    assert song_to_json(songs, pretty) == _reference(songs, pretty)
+    assert song_to_json([], pretty) == _reference([], pretty)
+
+
+@pytest.mark.parametrize('pretty', [False, True])
+def test_write_songs_matches_song_to_json(pretty):
+    songs = _demo_songs()
+    out = StringIO()
+    write_songs(iter(songs), out, pretty)
+    assert out.getvalue() == song_to_json(songs, pretty)
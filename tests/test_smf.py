@@ -0,0 +1,69 @@
+import random
+from dataclasses import replace
+from io import BytesIO
+
+import pytest
+from mido import Message, MetaMessage, MidiFile, MidiTrack
+
+from playdate_midi_converter.analysis import analyze, index
+from playdate_midi_converter.smf import index_smf, read_smf
+
+
+def _message(rng: random.Random):
+    time = rng.choice([0, 0, 5, 120, 20000, 300000])
+    kind = rng.randrange(9)
+    if kind < 3:
+        # runs of note messages on one channel are saved with running status
+        return Message('note_on', note=rng.randint(0, 127), velocity=rng.choice([0, 64, 127]), channel=rng.choice([0, 0, 9]), time=time)
+    if kind == 3:
+        return Message('note_off', note=rng.randint(0, 127), time=time)
+    if kind == 4:
+        return Message('control_change', control=7, value=3, time=time)
+    if kind == 5:
+        return Message('sysex', data=[1, 2, 3] * rng.randint(0, 50), time=time)
+    if kind == 6:
+        return MetaMessage('set_tempo', tempo=rng.randint(1, 16777215), time=time)
+    if kind == 7:
+        return MetaMessage('channel_prefix', channel=3, time=time)
+    return MetaMessage('lyrics', text='la' * rng.randint(0, 100), time=time)
+
+
+def _midi_bytes(seed: int) -> bytes:
+    rng = random.Random(seed)
+    midi_file = MidiFile(ticks_per_beat=rng.choice([480, 96]))
+    for number in range(rng.randint(1, 4)):
+        track = MidiTrack()
+        track.append(MetaMessage('track_name', name=f"track {number}"))
+        track.extend(_message(rng) for _ in range(rng.randint(0, 40)))
+        midi_file.tracks.append(track)
+    buf = BytesIO()
+    midi_file.save(file=buf)
+    return buf.getvalue()
+
+
+def _without_location(infos):
+    # mido doesn't know where the track chunks are
+    return [replace(info, offset=None, size=None) for info in infos]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_read_smf_matches_analyze(seed):
+    data = _midi_bytes(seed)
+    expected = analyze(MidiFile(file=BytesIO(data)))
+    assert read_smf(data) == expected
+    assert read_smf(data, index=index_smf(data)) == expected
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_index_smf_matches_index(seed):
+    data = _midi_bytes(seed)
+    assert _without_location(index_smf(data)) == index(MidiFile(file=BytesIO(data)))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_read_smf_tracks_keeps_grid(seed):
+    data = _midi_bytes(seed)
+    full = read_smf(data)
+    part = read_smf(data, index=index_smf(data), tracks={1})
+    assert [track.number for track in part.tracks] == [track.number for track in full.tracks if track.number == 1]
+    assert (part.tempo, part.lowest_time, part.ticks_per_beat) == (full.tempo, full.lowest_time, full.ticks_per_beat)
@@ -0,0 +1,56 @@
+import json
+from io import BytesIO, StringIO
+
+import pytest
+
+from playdate_midi_converter.json import song_to_json, write_songs
+from playdate_midi_converter.song import Channel, Note, Song, Track
+from playdate_midi_converter.update import update_songs
+
+
+def _song(song_id: int, name: str, value: int = 1) -> Song:
+    tracks = [Track(1, 'lead', [Note(value, 4, 2), Note(), Note(value, 5, 1)], 3, Channel.SINE)]
+    song = Song(id=song_id, bpm=120, name=name, tracks=tracks)
+    song.map_channels({tracks[0]: Channel.SINE})
+    return song
+
+
+def _songs_file(pretty: bool) -> bytes:
+    # names with escapes, brackets and a fake "id" key, longer than the small chunk sizes
+    songs = [
+        _song(1, 'first'),
+        _song(3, 'with \\"quotes\\" and [brackets] {braces} "id": 99'),
+        _song(5, 'x' * 300),
+        _song(8, 'last'),
+    ]
+    out = StringIO()
+    write_songs(songs, out, pretty)
+    return out.getvalue().encode('utf-8')
+
+
+def _update(source: bytes, pretty: bool, chunk_size: int) -> bytes:
+    out = BytesIO()
+    songs = [_song(3, 'replaced', 9), _song(4, 'inserted', 7), _song(10, 'appended', 6)]
+    update_songs(BytesIO(source), out, songs, remove=[8], pretty=pretty, chunk_size=chunk_size)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('pretty', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64])
+def test_small_chunks_match_one_chunk(pretty, chunk_size):
+    source = _songs_file(pretty)
+    assert _update(source, pretty, chunk_size) == _update(source, pretty, len(source) + 1)
+
+
+@pytest.mark.parametrize('pretty', [False, True])
+def test_update_songs(pretty):
+    source = _songs_file(pretty)
+    result = json.loads(_update(source, pretty, 2))
+    assert [song['id'] for song in result] == [1, 3, 4, 5, 10]
+    assert [song['name'] for song in result][1:3] == ['replaced', 'inserted']
+    # untouched songs are copied byte for byte
+    untouched = song_to_json(_song(5, 'x' * 300), pretty)
+    if pretty:
+        untouched = untouched.replace('\n', '\n    ')
+    assert untouched.encode('utf-8') in source
+    assert untouched.encode('utf-8') in _update(source, pretty, 2)